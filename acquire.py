@@ -0,0 +1,190 @@
+"""Headless batch acquisition, time-lapse and multi-position runs without the GUI.
+
+    python acquire.py protocol.json [-o output_dir] [--dry-run]
+
+The protocol is a JSON file, e.g.
+
+    {"devname": "Dev1", "sample_rate": 100000,
+     "scan": {"x_amp": 2, "y_amp": 1, "pixels_x": 200, "samples_per_pixel": 2, "ai_channels": ["/ai0", "/ai1"]},
+     "frames": 50,
+     "timepoints": 10, "interval": 60,
+     "positions": [[0, 0], [1.5, -0.5]],
+     "park": [3, 3]}
+
+scan holds WaveformGen attributes (a "trajectory" entry like {"pattern": "LineScan", "start": [-1, 0], ...} selects a
+trajectories pattern). Each position, an (x_offset, y_offset) pair or a dict that can also give it a name, is acquired
+for frames frames (or duration seconds) per timepoint, timepoints start interval seconds apart, and between timepoints
+the galvos are parked at park (volts) if given. Every acquisition streams to its own BigTIFF, t{timepoint}_{name}.tif,
+while it runs. Its recorder is flushed on a background thread while the next position is set up and started, each
+acquisition alternating between two frame rings so the flush never races the next acquisition. The achieved vs
+requested frame rates are reported at the end and saved in summary.json.
+"""
+import argparse
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import trajectories
+from framering import FrameRing
+from wavegenbase import WaveformGen
+
+
+def load_protocol(path):
+    with open(path) as f:
+        protocol = json.load(f)
+    assert ('frames' in protocol) != ('duration' in protocol), "Give either frames or duration"
+    return protocol
+
+
+def configure(gen, scan):
+    """Set the protocol's scan parameters on gen, only existing public attributes"""
+    for k, v in scan.items():
+        if k == 'trajectory':
+            v = dict(v)
+            v = getattr(trajectories, v.pop('pattern'))(**v) if v else None
+        elif k.startswith('_') or not hasattr(gen, k) or callable(getattr(gen, k)):
+            raise ValueError(f"Unknown scan parameter {k}")
+        setattr(gen, k, v)
+
+
+def positions(protocol):
+    """The protocol's positions as dicts with name, x_offset and y_offset (None to keep the scan's offsets)"""
+    spots = []
+    for p, spot in enumerate(protocol.get('positions') or [{}]):
+        if not isinstance(spot, dict):
+            spot = dict(zip(('x_offset', 'y_offset'), spot))
+        spots.append({'name': spot.get('name', f"p{p:02d}"), 'x_offset': spot.get('x_offset'),
+                      'y_offset': spot.get('y_offset')})
+    return spots
+
+
+def acquire_one(gen, path, frames=None, duration=None, metadata=None):
+    """Acquire frames frames (or for duration seconds) into path, returns the result with the recorder still
+    flushing. The recorder is detached from gen, call its stop()"""
+    stamps = []
+    done = threading.Event()
+
+    def on_frame(seq, frame):
+        stamps.append(time.perf_counter())
+        if frames and len(stamps) >= frames:
+            done.set()
+
+    gen.reading_image_callback = on_frame
+    gen.start_recording(path, max_frames=frames, metadata=metadata)
+    requested = gen.fps
+    t0 = time.perf_counter()
+    gen.start()
+    # Generous timeout in frame mode, in case the DAQ stalls
+    completed = done.wait(duration if duration else 2 * frames / requested + 5)
+    gen.stop()
+    gen.reading_image_callback = None
+    recorder = gen.stop_recording(wait=False)
+
+    achieved = (len(stamps) - 1) / (stamps[-1] - stamps[0]) if len(stamps) > 1 else None
+    result = {'path': path, 'frames': len(stamps), 'requested_frames': frames, 'completed': completed or not frames,
+              'requested_fps': requested, 'achieved_fps': achieved, 'wall_s': time.perf_counter() - t0,
+              'metrics': gen.metrics.snapshot()}
+    return result, recorder
+
+
+def run(protocol, output_dir, log=print):
+    os.makedirs(output_dir, exist_ok=True)
+    gen = WaveformGen(devname=protocol.get('devname', 'Dev1'), sample_rate=protocol.get('sample_rate', 20000))
+    configure(gen, protocol.get('scan', {}))
+    gen.prepare()
+    frames, duration = protocol.get('frames'), protocol.get('duration')
+    timepoints, interval = protocol.get('timepoints', 1), protocol.get('interval', 0)
+    park = protocol.get('park')
+    spots = positions(protocol)
+
+    flusher = ThreadPoolExecutor(max_workers=1, thread_name_prefix='flush')
+    flushes = []
+    results = []
+    spare_ring = None
+    t_start = time.perf_counter()
+    try:
+        for t in range(timepoints):
+            wait = t_start + t * interval - time.perf_counter()
+            if wait > 0:
+                log(f"Waiting {wait:0.1f} s for timepoint {t}")
+                time.sleep(wait)
+            for spot in spots:
+                for k in ('x_offset', 'y_offset'):
+                    if spot[k] is not None:
+                        setattr(gen, k, spot[k])
+                if gen.ring is not None:
+                    # Queued frames of the previous acquisition are still being copied out of its ring, use the
+                    # other one, as soon as the flush that last used it is done
+                    if len(flushes) >= 2:
+                        flushes[-2].result()
+                    ring = gen.ring
+                    if spare_ring is None or spare_ring.shape != ring.shape or spare_ring.dtype != ring.dtype:
+                        spare_ring = FrameRing(ring.capacity, ring.shape, dtype=ring.dtype)
+                    gen.ring, spare_ring = spare_ring, ring
+                path = os.path.join(output_dir, f"t{t:04d}_{spot['name']}.tif")
+                metadata = {'timepoint': t, 'position': spot['name'], 'x_offset': gen.x_offset,
+                             'y_offset': gen.y_offset}
+                result, recorder = acquire_one(gen, path, frames, duration, metadata=metadata)
+                result.update(timepoint=t, position=spot['name'])
+                results.append(result)
+                flushes.append(flusher.submit(recorder.stop))
+                log(f"t{t} {spot['name']}: {result['frames']} frames, {result['achieved_fps'] or 0:0.2f} of "
+                    f"{result['requested_fps']:0.2f} fps")
+            if park is not None:
+                # Setting static voltages needs the tasks released, they're set up again for the next timepoint
+                gen.close()
+                gen.park(*park)
+    finally:
+        gen.stop()
+        gen.close()
+        for result, flush in zip(results, flushes):
+            result['recorder'] = flush.result()
+        flusher.shutdown()
+
+    summary = {'protocol': protocol, 'results': results, 'total_s': time.perf_counter() - t_start}
+    with open(os.path.join(output_dir, 'summary.json'), 'w') as f:
+        json.dump(summary, f, indent=1, default=str)
+    report(results, log)
+    return summary
+
+
+def report(results, log=print):
+    log(f"{'acquisition':<14}{'frames':>8}{'written':>9}{'dropped':>9}{'requested fps':>15}{'achieved fps':>14}")
+    for r in results:
+        rec = r.get('recorder') or {}
+        achieved = f"{r['achieved_fps']:0.2f}" if r['achieved_fps'] else '-'
+        name = f"t{r['timepoint']} {r['position']}"
+        log(f"{name:<14}{r['frames']:>8}{rec.get('written', '-'):>9}"
+            f"{rec.get('dropped', '-'):>9}{r['requested_fps']:>15.2f}{achieved:>14}")
+    achieved = [r['achieved_fps'] for r in results if r['achieved_fps']]
+    if achieved:
+        log(f"Achieved {sum(achieved) / len(achieved):0.2f} fps on average, "
+            f"{min(achieved) / results[0]['requested_fps']:0.1%} of requested at worst")
+
+
+def plan(protocol, log=print):
+    """Print what run() would do, without touching the DAQ"""
+    n_spots = len(positions(protocol))
+    timepoints = protocol.get('timepoints', 1)
+    log(f"{timepoints} timepoints x {n_spots} positions, "
+        + (f"{protocol['frames']} frames" if 'frames' in protocol else f"{protocol['duration']} s") + " each"
+        + (f", every {protocol['interval']} s" if protocol.get('interval') else ''))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('protocol', help='Protocol JSON file')
+    parser.add_argument('-o', '--output', default='acquisition', help='Output directory')
+    parser.add_argument('--dry-run', action='store_true', help='Only print the plan')
+    args = parser.parse_args(argv)
+
+    protocol = load_protocol(args.protocol)
+    plan(protocol)
+    if not args.dry_run:
+        run(protocol, args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,220 @@
+"""Frame assembly, turning the AI samples of a frame into pixels.
+
+Everything here works on views of the read buffer and writes into preallocated output (e.g. a FrameRing slot), so it
+can run inside the DAQ callback without allocating per frame.
+"""
+import numpy as np
+
+BIN_MODES = ('mean', 'sum', 'max', 'count')
+
+
+class PixelBinner:
+    """Reduces the samples_per_pixel samples collected at each pixel into one value.
+
+    The samples of a frame are viewed as (pixels_y, pixels_x, samples_per_pixel) and reduced along the last axis with a
+    single vectorized call. Modes are 'mean', 'sum', 'max' and 'count', a photon counting style sum of the samples
+    above threshold.
+    """
+
+    def __init__(self, pixels_y, pixels_x, samples_per_pixel, mode='mean', threshold=0.0):
+        assert mode in BIN_MODES, f"Unknown binning mode {mode}, pick one of {BIN_MODES}"
+        self.shape = (pixels_y, pixels_x, samples_per_pixel)
+        self.mode = mode
+        self.threshold = threshold
+        self._mask = np.empty(self.shape, dtype=bool) if mode == 'count' else None
+        # Reducing straight into a strided float32 output makes numpy allocate casting buffers on every call, so
+        # reduce into a contiguous float64 scratch frame and copy that over instead
+        self._scratch = np.empty(self.shape[:2], dtype=np.float64)
+
+    def __call__(self, samples, out):
+        """Bin one frame of samples (flat, pixels_y * pixels_x * samples_per_pixel long) into out, shape (y, x).
+
+        out can be any (strided) view, e.g. one channel plane of a ring slot. For integer out (raw ADC counts) the
+        mean is rounded to the nearest count.
+        """
+        return self._reduce(samples.reshape(self.shape), out)
+
+    def _reduce(self, view, out):
+        if self.mode != 'count' and self.shape[2] == 1:
+            # Float values into integer out only come from _Lerp, already rounded to whole counts
+            np.copyto(out, view[..., 0], casting='same_kind' if out.dtype.kind == 'f' else 'unsafe')
+            return out
+        if self.mode == 'count':
+            np.greater(view, self.threshold, out=self._mask)
+            np.sum(self._mask, axis=2, out=self._scratch)
+        elif self.mode == 'mean':
+            np.mean(view, axis=2, out=self._scratch)
+        elif self.mode == 'sum':
+            np.sum(view, axis=2, out=self._scratch)
+        else:
+            np.max(view, axis=2, out=self._scratch)
+        if out.dtype.kind == 'f':
+            np.copyto(out, self._scratch, casting='same_kind')
+        else:
+            if self.mode == 'mean':
+                np.rint(self._scratch, out=self._scratch)
+            np.copyto(out, self._scratch, casting='unsafe')
+        return out
+
+
+class GatherBinner(PixelBinner):
+    """PixelBinner for arbitrary scan patterns, index (rows, cols, k) holds the samples reduced into each pixel.
+
+    The samples are gathered with a single np.take into a preallocated (rows, cols, k) buffer and reduced like
+    PixelBinner does, samples not in the index (e.g. galvo transits) are simply never looked at.
+    """
+
+    def __init__(self, index, mode='mean', threshold=0.0, dtype=np.float64):
+        super().__init__(*index.shape, mode=mode, threshold=threshold)
+        self.index = index
+        self._gathered = np.empty(index.shape, dtype=dtype)  # In the sample dtype, np.take can't cast
+
+    def __call__(self, samples, out):
+        """Bin the samples of one frame (or row periodic chunk) into out, shape (rows, cols)"""
+        return self._reduce(np.take(samples, self.index, out=self._gathered), out)
+
+
+class _Lerp:
+    """samples[idx0] + weights * (samples[idx1] - samples[idx0]) into a preallocated float64 scratch.
+
+    Two np.take calls and a lerp. np.take can't cast, so integer (raw ADC count) samples are gathered into a scratch
+    of their own dtype first, and the result is rounded to whole counts.
+    """
+
+    def __init__(self, idx0, idx1, weights, dtype=np.float64):
+        self.idx0 = idx0
+        self.idx1 = idx1
+        self.weights = weights
+        self._a = np.empty(idx0.shape, dtype=np.float64)
+        self._b = np.empty(idx0.shape, dtype=np.float64)
+        self._raw = np.empty(idx0.shape, dtype=dtype) if np.dtype(dtype).kind != 'f' else None
+
+    def __call__(self, samples):
+        if self._raw is None:
+            np.take(samples, self.idx0, out=self._a)
+            np.take(samples, self.idx1, out=self._b)
+        else:
+            np.copyto(self._a, np.take(samples, self.idx0, out=self._raw))
+            np.copyto(self._b, np.take(samples, self.idx1, out=self._raw))
+        self._b -= self._a
+        self._b *= self.weights
+        self._a += self._b
+        if self._raw is not None:
+            np.rint(self._a, out=self._a)
+        return self._a
+
+
+class ResamplingBinner(PixelBinner):
+    """PixelBinner over samples interpolated at uniformly spaced positions, see linearization_map.
+
+    idx0/weights (rows, cols, samples_per_pixel) give the sample before each position and the weight of the one
+    after it, so a frame is two np.take calls and a lerp before the usual reduction.
+    """
+
+    def __init__(self, idx0, weights, mode='mean', threshold=0.0, dtype=np.float64):
+        super().__init__(*idx0.shape, mode=mode, threshold=threshold)
+        self.lerp = _Lerp(idx0, idx0 + 1, weights, dtype)
+
+    def __call__(self, samples, out):
+        return self._reduce(self.lerp(samples), out)
+
+
+def linearization_map(line_positions, n_lines, pixels, samples_per_pixel=1, smooth=0):
+    """Index/weight arrays for ResamplingBinner that resample each line at uniformly spaced fast axis positions.
+
+    line_positions is the fast axis position of every sample of one line, either the commanded waveform or the
+    galvo position measured through an AO loopback (pass smooth, in samples, for noisy measurements). Only the
+    longest stretch of the line where the position increases is used, so the flyback and the turnarounds are never
+    sampled, and the pixels evenly cover the range that stretch actually reaches.
+    """
+    x = np.asarray(line_positions, dtype=np.float64)
+    if smooth:
+        from scipy.ndimage import gaussian_filter1d
+        x = gaussian_filter1d(x, smooth, mode='wrap')
+    if np.median(np.diff(x)) < 0:  # Line scanned towards negative positions
+        x = -x
+    increasing = np.concatenate(([False], np.diff(x) > 0, [False]))
+    edges = np.flatnonzero(np.diff(increasing.astype(np.int8)))
+    starts, ends = edges[::2], edges[1::2]
+    longest = np.argmax(ends - starts)
+    first, last = starts[longest], ends[longest]  # Sample range of the increasing stretch
+
+    n = pixels * samples_per_pixel
+    targets = x[first] + (x[last] - x[first]) * (np.arange(n) + 0.5) / n
+    position = np.interp(targets, x[first:last + 1], np.arange(first, last + 1))
+    i0 = np.minimum(np.floor(position).astype(np.intp), last - 1)
+    weights = (position - i0).reshape(1, pixels, samples_per_pixel)
+    idx0 = (np.arange(n_lines)[:, None] * len(x) + i0).reshape(n_lines, pixels, samples_per_pixel)
+    return idx0, np.ascontiguousarray(np.broadcast_to(weights, idx0.shape))
+
+
+class LineCorrector:
+    """Flips the reversed lines of a bidirectional scan and shifts them by a sub-sample phase offset.
+
+    phase (in samples) corrects for the galvo lagging the command, which shifts forward and reverse lines in opposite
+    directions, about twice the lag. The gather positions and interpolation weights are precomputed, so correcting a
+    frame is two np.take calls and a lerp, in place on the odd lines of the sample buffer.
+    """
+
+    def __init__(self, n_lines, samples_per_line, phase=0.0, dtype=np.float64):
+        self.n_lines = n_lines
+        self.samples_per_line = samples_per_line
+        self.phase = phase
+
+        pos = np.clip(np.arange(samples_per_line)[::-1] + phase, 0, samples_per_line - 1)
+        i0 = np.floor(pos).astype(np.intp)
+        i1 = np.minimum(i0 + 1, samples_per_line - 1)
+        row_starts = np.arange(1, n_lines, 2)[:, None] * samples_per_line
+        self.lerp = _Lerp(row_starts + i0, row_starts + i1, pos - i0, dtype)
+
+    def __call__(self, samples):
+        """Correct one frame of samples (flat, n_lines * samples_per_line long) in place"""
+        samples.reshape(self.n_lines, self.samples_per_line)[1::2] = self.lerp(samples)
+        return samples
+
+
+def scale_counts(counts, coeffs, out=None):
+    """Raw ADC counts to volts, vectorized over a whole (channel, ...) array.
+
+    coeffs holds one polynomial per channel, lowest order first, as returned by the AI task's scaling_coeffs().
+    """
+    counts = np.asarray(counts)
+    coeffs = np.asarray(coeffs, dtype=np.float64).reshape((len(coeffs), -1) + (1,) * (counts.ndim - 1))
+    if out is None:
+        out = np.empty(counts.shape, dtype=np.float32)
+    # Horner's scheme, one pass over the data per coefficient
+    np.multiply(counts, coeffs[:, -1], out=out, casting='unsafe')
+    for c in coeffs[:, -2:0:-1].swapaxes(0, 1):
+        out += c
+        out *= counts
+    out += coeffs[:, 0]
+    return out
+
+
+def estimate_line_phase(samples, n_lines, samples_per_line, max_shift=None, corrected=False):
+    """Estimate the LineCorrector phase (samples) of a bidirectional frame by cross-correlating adjacent lines.
+
+    The forward lines are correlated with the flipped reverse lines, averaged over the frame, and the peak is refined
+    to sub-sample precision with a parabolic fit. If the frame was already run through a LineCorrector
+    (corrected=True), the result is the residual to add to its phase.
+    """
+    lines = np.asarray(samples, dtype=np.float64).reshape(n_lines, samples_per_line)
+    n_pairs = n_lines // 2
+    forward = lines[0:2 * n_pairs:2]
+    reverse = lines[1:2 * n_pairs:2] if corrected else lines[1:2 * n_pairs:2, ::-1]
+    forward = forward - forward.mean(axis=1, keepdims=True)
+    reverse = reverse - reverse.mean(axis=1, keepdims=True)
+
+    n = 2 * samples_per_line
+    xcorr = np.fft.irfft((np.fft.rfft(forward, n) * np.conj(np.fft.rfft(reverse, n))).sum(axis=0), n)
+    lags = np.fft.fftfreq(n, 1 / n).astype(int)
+    if max_shift is None:
+        max_shift = samples_per_line // 4
+    valid = np.abs(lags) <= max_shift
+    peak = np.flatnonzero(valid)[np.argmax(xcorr[valid])]
+
+    # Sub-sample refinement
+    y0, y1, y2 = xcorr[peak - 1], xcorr[peak], xcorr[(peak + 1) % n]
+    denom = y0 - 2 * y1 + y2
+    offset = 0.5 * (y0 - y2) / denom if denom else 0.0
+    return float(lags[peak] + offset)
@@ -0,0 +1,165 @@
+"""Headless benchmarks of the scan hot paths, run against the simulated DAQ.
+
+Sweeps the parameters the GUI exposes and for each point measures the time per waveform_chunks() call (cold compile and
+cached), the time per AO/AI callback, the bytes allocated per frame in the callbacks, and the highest sample_rate at
+which the callbacks still fit in the frame period (1/fps). Results are written as JSON so runs from different versions
+can be compared, e.g.:
+
+    python benchmark.py --quick -o bench_before.json
+    python benchmark.py --quick -o bench_after.json --compare bench_before.json
+"""
+import argparse
+import itertools
+import json
+import platform
+import statistics
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+from daqbackend import SimBackend
+from wavegenbase import WaveformGen
+
+FULL_GRID = {'pixels_x': [50, 100, 200, 500],
+             'samples_per_pixel': [1, 2, 5, 10, 20],
+             'aspect': [(1, 1), (2, 1), (1, 2)],  # (x_amp, y_amp)
+             'n_channels': [1, 2, 4]}
+QUICK_GRID = {'pixels_x': [50, 200, 500],
+              'samples_per_pixel': [1, 5, 20],
+              'aspect': [(2, 1)],
+              'n_channels': [1, 2]}
+
+
+def timed(fn, times, allocations=None):
+    """Wrap a DAQ callback, appending its wall time (and bytes allocated, while tracemalloc is on) to the lists"""
+    def wrapper(*args):
+        if allocations is not None:
+            tracemalloc.stop()  # restart to reset the peak, tracemalloc.reset_peak needs python 3.9
+            tracemalloc.start()
+        t0 = time.perf_counter()
+        ret = fn(*args)
+        times.append(time.perf_counter() - t0)
+        if allocations is not None:
+            allocations.append(tracemalloc.get_traced_memory()[1])
+        return ret
+    return wrapper
+
+
+def summarize(times):
+    return {'median': statistics.median(times), 'max': max(times)} if times else None
+
+
+def bench_point(gen, pixels_x, samples_per_pixel, aspect, n_channels, frames=5):
+    gen.pixels_x = pixels_x
+    gen.samples_per_pixel = samples_per_pixel
+    gen.x_amp, gen.y_amp = aspect
+    gen.ai_channels = [f'/ai{i}' for i in range(n_channels)]
+    result = {'pixels_x': pixels_x, 'pixels_y': gen.pixels_y, 'samples_per_pixel': samples_per_pixel,
+              'x_amp': aspect[0], 'y_amp': aspect[1], 'n_channels': n_channels,
+              'samples_per_frame': gen.samples_per_refresh, 'samples_per_chunk': gen.samples_per_chunk}
+
+    gen.waveform_cache.clear()
+    t0 = time.perf_counter()
+    gen.waveform_chunks()
+    result['waveform_compile_s'] = time.perf_counter() - t0
+    warm = []
+    for _ in range(frames):
+        t0 = time.perf_counter()
+        gen.waveform_chunks()
+        warm.append(time.perf_counter() - t0)
+    result['waveform_s'] = summarize(warm)
+
+    backend = gen.backend
+    gen.init_tasks()
+    timings = {'ao': [], 'ai': []}
+    allocations = {'ao': [], 'ai': []}
+    try:
+        # One pass for timing, then one frame with tracemalloc on (which slows everything down) for the allocations
+        for measure_alloc in (False, True):
+            times = {'ao': [], 'ai': []} if measure_alloc else timings
+            backend.ao.callback = timed(gen.writing_task_callback, times['ao'],
+                                        allocations['ao'] if measure_alloc else None)
+            backend.ai.callback = timed(gen.reading_task_callback, times['ai'],
+                                        allocations['ai'] if measure_alloc else None)
+            gen.start()
+            backend.advance(gen.samples_per_refresh * (1 if measure_alloc else frames))
+            gen.stop()
+    finally:
+        if tracemalloc.is_tracing():
+            tracemalloc.stop()
+        gen.close()
+
+    result['writing_callback_s'] = summarize(timings['ao'])
+    result['reading_callback_s'] = summarize(timings['ai'])
+    result['writing_callback_bytes'] = max(allocations['ao'], default=None)
+    result['reading_callback_bytes'] = max(allocations['ai'], default=None)
+    result['errors'] = [repr(e) for e in backend.callback_errors]
+    backend.callback_errors.clear()
+
+    if timings['ao'] and timings['ai'] and not result['errors']:
+        per_chunk = result['writing_callback_s']['median'] + result['reading_callback_s']['median']
+        # Callback work scales with samples per callback, the budget per callback is samples_per_chunk / sample_rate
+        result['max_sample_rate'] = gen.samples_per_chunk / per_chunk
+    else:
+        result['max_sample_rate'] = None
+    return result
+
+
+def compare(results, baseline, threshold=1.2):
+    """Print the points whose callback times got more than threshold-fold slower than in the baseline file"""
+    def key(r):
+        return r['pixels_x'], r['samples_per_pixel'], r['x_amp'], r['y_amp'], r['n_channels']
+
+    old = {key(r): r for r in baseline['results']}
+    for r in results['results']:
+        b = old.get(key(r))
+        if b is None:
+            continue
+        for metric in ('waveform_s', 'writing_callback_s', 'reading_callback_s'):
+            if r[metric] and b[metric] and r[metric]['median'] > threshold * b[metric]['median']:
+                print(f"Regression {key(r)} {metric}: {b[metric]['median'] * 1e3:0.3f} ms "
+                      f"-> {r[metric]['median'] * 1e3:0.3f} ms")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-o', '--output', default='benchmark_results.json')
+    parser.add_argument('--quick', action='store_true', help='Run a smaller parameter grid')
+    parser.add_argument('--frames', type=int, default=5, help='Frames timed per parameter point')
+    parser.add_argument('--sample-rate', type=float, default=20000)
+    parser.add_argument('--raw', action='store_true', help='Acquire raw int16 counts')
+    parser.add_argument('--lines-per-chunk', type=int, help='Lines per DAQ callback, default a whole frame')
+    parser.add_argument('--compare', help='Previous results file to check for regressions')
+    args = parser.parse_args(argv)
+
+    grid = QUICK_GRID if args.quick else FULL_GRID
+    backend = SimBackend(mode='loopback', noise=0, realtime=False, print_errors=False)
+    gen = WaveformGen(devname='sim', sample_rate=args.sample_rate, backend=backend)
+    gen.lines_per_chunk = args.lines_per_chunk
+    gen.raw = args.raw
+
+    results = {'python': sys.version, 'platform': platform.platform(), 'numpy': np.__version__,
+               'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'), 'sample_rate': args.sample_rate,
+               'lines_per_chunk': args.lines_per_chunk, 'raw': args.raw, 'results': []}
+    for point in itertools.product(*grid.values()):
+        r = bench_point(gen, *point, frames=args.frames)
+        results['results'].append(r)
+        print(f"{r['pixels_x']}x{r['pixels_y']} px, {r['samples_per_pixel']} samples/px, {r['n_channels']} ch: "
+              f"AO {r['writing_callback_s']['median'] * 1e3 if r['writing_callback_s'] else float('nan'):0.3f} ms, "
+              f"AI {r['reading_callback_s']['median'] * 1e3 if r['reading_callback_s'] else float('nan'):0.3f} ms, "
+              f"AI alloc {r['reading_callback_bytes']} B, max rate {r['max_sample_rate'] or float('nan'):0.0f} Hz"
+              + (f", errors: {r['errors'][0]}" if r['errors'] else ''))
+
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=1)
+    print(f"Saved results to {args.output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,573 @@
+"""Device backends used by WaveformGen.
+
+A backend creates the AI/AO tasks and sets static voltages. The tasks it returns all have the same small interface:
+start/stop/close, commit, set_buffer_size(n), read(buffer, num_samples), avail_samples() and scaling_coeffs() for AI or
+write(data) and space_avail() for AO, and register_every_n_samples(n, callback), where callback follows the nidaqmx every-n-samples prototype
+(task_idx, event_type, num_samples, callback_data). Buffer sizes and callbacks can be changed on a stopped task.
+
+AI reads into a float64 buffer return volts, reads into an int16 buffer return the raw ADC counts, which
+scaling_coeffs() converts to volts (one polynomial per channel, lowest order first, see assembly.scale_counts).
+
+NIBackend talks to a real NI board through nidaqmx, its capabilities (rate limits, channels) come from a DeviceCache
+so they're only queried from the driver the first time. SimBackend is a software simulator that runs the sample clock on a
+timer thread, so the whole scan pipeline can run (and be profiled) without any hardware.
+"""
+import json
+import os
+import re
+import threading
+import time
+
+import numpy as np
+
+
+DEVICE_CACHE = os.path.join(os.path.expanduser('~'), '.joe_scan_devices.json')
+DEVICE_CACHE_VERSION = 1
+
+
+def open_backend(devname, **kwargs):
+    """Returns the backend for devname, 'sim' gives a SimBackend, 'auto' the first NI device, anything else is an NI
+    device name"""
+    if devname == 'sim':
+        return SimBackend(**kwargs)
+    return NIBackend(devname, **kwargs)
+
+
+def discover_device(device):
+    """Capabilities of an nidaqmx Device that WaveformGen uses, each one a driver query"""
+    return {'product_type': device.product_type,
+            'serial_num': device.dev_serial_num,
+            'ao_min_rate': device.ao_min_rate,
+            'ao_max_rate': device.ao_max_rate,
+            'ai_max_single_chan_rate': device.ai_max_single_chan_rate,
+            'ai_max_multi_chan_rate': device.ai_max_multi_chan_rate,
+            'ai_channels': list(device.ai_physical_chans.channel_names),
+            'ao_channels': list(device.ao_physical_chans.channel_names)}
+
+
+class DeviceCache:
+    """Device capabilities discovered once and kept in a JSON file, so connecting doesn't query them all again.
+
+    An entry is only used while the device still answers to its name with the same product type and serial number,
+    under the driver version it was discovered with. Anything else (board swapped or renamed, driver updated, file
+    missing or unreadable) rediscovers the device and rewrites its entry. The name picked for 'auto' is cached too.
+    """
+
+    def __init__(self, nidaqmx, path=DEVICE_CACHE):
+        self.nidaqmx = nidaqmx
+        self.path = path
+        self.entries = {}
+        self.auto = None
+        self.hit = None  # Whether the last lookup was served from the cache
+        self._driver_version = None
+        self._checked = set()  # Names validated by this instance, 'auto' checks its pick before looking it up
+        try:
+            with open(path) as f:
+                data = json.load(f)
+            if data.get('version') == DEVICE_CACHE_VERSION:
+                self.entries = data['devices']
+                self.auto = data.get('auto')
+        except (OSError, ValueError, KeyError):
+            pass
+
+    @property
+    def driver_version(self):
+        if self._driver_version is None:
+            self._driver_version = list(self.nidaqmx.system.System.local().driver_version)
+        return self._driver_version
+
+    def _valid(self, devname, entry):
+        if devname in self._checked:
+            return True
+        if entry.get('driver_version') != self.driver_version:
+            return False
+        device = self.nidaqmx.system.Device(devname)
+        try:
+            valid = (device.product_type, device.dev_serial_num) == (entry['product_type'], entry['serial_num'])
+        except self.nidaqmx.errors.DaqError:  # Not there (anymore)
+            return False
+        if valid:
+            self._checked.add(devname)
+        return valid
+
+    def capabilities(self, devname, refresh=False):
+        entry = self.entries.get(devname)
+        self.hit = entry is not None and not refresh and self._valid(devname, entry)
+        if not self.hit:
+            entry = dict(discover_device(self.nidaqmx.system.Device(devname)), driver_version=self.driver_version)
+            self.entries[devname] = entry
+            self.save()
+        return entry
+
+    def auto_devname(self):
+        """The first attached NI device, the cached pick if it's still there"""
+        if self.auto in self.entries and self._valid(self.auto, self.entries[self.auto]):
+            return self.auto
+        self.auto = self.nidaqmx.system.System.local().devices.device_names[0]
+        self.save()
+        return self.auto
+
+    def save(self):
+        try:
+            with open(self.path, 'w') as f:
+                json.dump({'version': DEVICE_CACHE_VERSION, 'auto': self.auto, 'devices': self.entries}, f, indent=1)
+        except OSError as e:  # A read-only home only costs the next startup a rediscovery
+            print(f"Could not save the device cache {self.path}: {e}")
+
+
+class NIBackend:
+    def __init__(self, devname, device_cache=DEVICE_CACHE, refresh=False):
+        # device_cache is the path of the DeviceCache file, None queries the device every time
+        import nidaqmx
+        self.nidaqmx = nidaqmx
+        if device_cache is not None:
+            cache = DeviceCache(nidaqmx, device_cache)
+            if devname == 'auto':
+                devname = cache.auto_devname()
+            self.capabilities = cache.capabilities(devname, refresh=refresh)
+            self.cached = cache.hit
+        else:
+            if devname == 'auto':
+                devname = nidaqmx.system.System.local().devices.device_names[0]
+            self.capabilities = discover_device(nidaqmx.system.Device(devname))
+            self.cached = False
+        self.devname = devname
+        self.product_type = self.capabilities['product_type']
+        self.ao_min_rate = self.capabilities['ao_min_rate']
+        self.ao_max_rate = self.capabilities['ao_max_rate']
+
+    def ai_max_rate(self, n_channels=1):
+        """Max AI sample rate summed over all channels of a task"""
+        if n_channels == 1:
+            return self.capabilities['ai_max_single_chan_rate']
+        return self.capabilities['ai_max_multi_chan_rate']
+
+    def _ai_args(self, ai_args):
+        ai_args = dict(ai_args)
+        if isinstance(ai_args.get('terminal_config'), str):
+            ai_args['terminal_config'] = self.nidaqmx.constants.TerminalConfiguration[ai_args['terminal_config']]
+        return ai_args
+
+    def create_ai_task(self, channels, sample_rate, buffer_size, start_trigger=None, **ai_args):
+        from nidaqmx import stream_readers
+        constants = self.nidaqmx.constants
+        task = self.nidaqmx.Task()
+        for ch in channels:
+            task.ai_channels.add_ai_voltage_chan(self.devname + ch, **self._ai_args(ai_args))
+        task.timing.cfg_samp_clk_timing(rate=sample_rate, sample_mode=constants.AcquisitionType.CONTINUOUS)
+        if start_trigger is not None:
+            task.triggers.start_trigger.cfg_dig_edge_start_trig(start_trigger, trigger_edge=constants.Edge.RISING)
+        task.in_stream.input_buf_size = buffer_size
+        return NIAITask(task, stream_readers.AnalogMultiChannelReader(task.in_stream),
+                        stream_readers.AnalogUnscaledReader(task.in_stream))
+
+    def create_ao_task(self, channels, sample_rate, buffer_size, **ao_args):
+        from nidaqmx import stream_writers
+        task = self.nidaqmx.Task()
+        for ch in channels:
+            task.ao_channels.add_ao_voltage_chan(self.devname + ch, **ao_args)
+        task.timing.cfg_samp_clk_timing(rate=sample_rate, sample_mode=self.nidaqmx.constants.AcquisitionType.CONTINUOUS)
+        task.out_stream.output_buf_size = buffer_size
+        return NIAOTask(task, stream_writers.AnalogMultiChannelWriter(task.out_stream))
+
+    def set_voltages(self, channels, voltages, **ao_args):
+        # make temp channel and writer
+        with self.nidaqmx.Task() as temptask:
+            for ch in channels:
+                temptask.ao_channels.add_ao_voltage_chan(self.devname + ch, **ao_args)
+
+            temptask.write(np.asarray(voltages, dtype=np.float64), timeout=2.0, auto_start=True)
+            temptask.wait_until_done()
+            temptask.stop()
+
+
+class NITask:
+    def __init__(self, task):
+        self.task = task
+        self.registered = False
+
+    def commit(self):
+        # A committed task goes back to the committed (not unreserved) state on stop, so restarting it is cheap
+        from nidaqmx.constants import TaskMode
+        self.task.control(TaskMode.TASK_COMMIT)
+
+    def register_every_n_samples(self, n, callback):
+        if self.registered:  # DAQmx only allows one every n samples callback, unregister the old one first
+            self._register(n, None)
+        self._register(n, callback)
+        self.registered = True
+
+    def start(self):
+        self.task.start()
+
+    def stop(self):
+        self.task.stop()
+
+    def close(self):
+        self.task.close()
+
+
+class NIAITask(NITask):
+    def __init__(self, task, reader, raw_reader):
+        super().__init__(task)
+        self.reader = reader
+        self.raw_reader = raw_reader
+
+    def read(self, buffer, num_samples):
+        from nidaqmx.constants import WAIT_INFINITELY
+        if buffer.dtype == np.int16:
+            return self.raw_reader.read_int16(buffer, num_samples, timeout=WAIT_INFINITELY)
+        return self.reader.read_many_sample(buffer, num_samples, timeout=WAIT_INFINITELY)
+
+    def scaling_coeffs(self):
+        """Per channel polynomial coefficients (lowest order first) from raw counts to volts"""
+        return [list(ch.ai_dev_scaling_coeff) for ch in self.task.ai_channels]
+
+    def set_buffer_size(self, n):
+        self.task.in_stream.input_buf_size = n
+
+    def avail_samples(self):
+        """Samples per channel waiting in the input buffer"""
+        return self.task.in_stream.avail_samp_per_chan
+
+    def _register(self, n, callback):
+        self.task.register_every_n_samples_acquired_into_buffer_event(n, callback)
+
+
+class NIAOTask(NITask):
+    def __init__(self, task, writer):
+        super().__init__(task)
+        self.writer = writer
+
+    def write(self, data, timeout=5.0):
+        return self.writer.write_many_sample(data, timeout=timeout)
+
+    def set_buffer_size(self, n):
+        self.task.out_stream.output_buf_size = n
+
+    def space_avail(self):
+        """Free space, in samples per channel, in the output buffer"""
+        return self.task.out_stream.space_avail
+
+    def _register(self, n, callback):
+        self.task.register_every_n_samples_transferred_from_buffer_event(n, callback)
+
+
+class SimulatedDAQError(RuntimeError):
+    pass
+
+
+class _SampleFifo:
+    """Circular (n_channels, size) sample buffer, standing in for the on-board/driver buffers"""
+
+    def __init__(self, n_channels, size):
+        self.data = np.zeros((n_channels, size), dtype=np.float64)
+        self.size = size
+        self.head = 0  # next sample to read
+        self.count = 0
+
+    @property
+    def space(self):
+        return self.size - self.count
+
+    def put(self, samples):
+        """Append samples, overwriting the oldest ones if full. Returns the number of samples lost."""
+        n = samples.shape[1]
+        if n >= self.size:
+            lost = self.count + n - self.size
+            self.data[:] = samples[:, n - self.size:]
+            self.head, self.count = 0, self.size
+            return lost
+        lost = max(0, n - self.space)
+        if lost:
+            self.head = (self.head + lost) % self.size
+            self.count -= lost
+        tail = (self.head + self.count) % self.size
+        first = min(n, self.size - tail)
+        self.data[:, tail:tail + first] = samples[:, :first]
+        self.data[:, :n - first] = samples[:, first:]
+        self.count += n
+        return lost
+
+    def get(self, out):
+        """Fill out, shape (n_channels, n), with the oldest samples. Returns the number of samples actually read."""
+        n = min(out.shape[1], self.count)
+        first = min(n, self.size - self.head)
+        out[:, :first] = self.data[:, self.head:self.head + first]
+        out[:, first:n] = self.data[:, :n - first]
+        self.head = (self.head + n) % self.size
+        self.count -= n
+        return n
+
+
+class SimTask:
+    def __init__(self, backend, channels, sample_rate, buffer_size, args):
+        self.backend = backend
+        self.channels = list(channels)
+        self.sample_rate = sample_rate
+        self.fifo = _SampleFifo(len(self.channels), buffer_size)  # Per channel, like the nidaqmx buffer sizes
+        self.args = args  # min_val/max_val etc. as passed to the channel creation
+        self.running = False
+        self.every_n = None
+        self.callback = None
+        self.counter = 0  # samples transferred/acquired since start, for the every n samples events
+
+    def register_every_n_samples(self, n, callback):
+        assert not self.running, "Can't register callbacks on a running task"
+        self.every_n = n
+        self.callback = callback
+
+    def set_buffer_size(self, n):
+        assert not self.running, "Can't resize the buffer of a running task"
+        if n != self.fifo.size:
+            self.fifo = _SampleFifo(len(self.channels), n)
+
+    def commit(self):
+        pass
+
+    def start(self):
+        self.running = True
+        self.counter = 0
+        self.backend._task_started(self)
+
+    def stop(self):
+        with self.backend._lock:  # Not in the middle of clocking samples through
+            self.running = False
+            # Like the driver, whatever was left in the buffer is discarded, AO has to be written again before a restart
+            self.fifo.head = self.fifo.count = 0
+        self.backend._task_stopped(self)
+
+    def close(self):
+        self.stop()
+        self.backend._task_closed(self)
+
+
+class SimAITask(SimTask):
+    def __init__(self, backend, channels, sample_rate, buffer_size, start_trigger=None, **ai_args):
+        super().__init__(backend, channels, sample_rate, buffer_size, ai_args)
+        self.start_trigger = start_trigger
+        self.overrun = False  # Set when samples were lost, the next read raises like the real driver would
+        # A 16 bit ADC spanning the channel range, with a small offset so forgetting c0 shows up
+        lo, hi = ai_args.get('min_val', -10), ai_args.get('max_val', 10)
+        self.coeffs = [(lo + hi) / 2 + 1e-4, (hi - lo) / 65536, 0.0, 0.0]
+        self._volts = None
+
+    def read(self, buffer, num_samples):
+        if self.overrun:
+            self.overrun = False
+            raise SimulatedDAQError("Simulated AI buffer overrun, samples were lost")
+        if buffer.dtype != np.int16:
+            return self.fifo.get(buffer[:, :num_samples])
+        if self._volts is None or self._volts.shape[1] < num_samples:
+            self._volts = np.empty((len(self.channels), num_samples))
+        volts = self._volts[:, :num_samples]
+        got = self.fifo.get(volts)
+        volts -= self.coeffs[0]
+        volts /= self.coeffs[1]
+        np.rint(volts, out=volts)
+        np.clip(volts, -32768, 32767, out=volts)
+        np.copyto(buffer[:, :num_samples], volts, casting='unsafe')
+        return got
+
+    def scaling_coeffs(self):
+        return [list(self.coeffs) for _ in self.channels]
+
+    def avail_samples(self):
+        return self.fifo.count
+
+
+class SimAOTask(SimTask):
+    def __init__(self, backend, channels, sample_rate, buffer_size, **ao_args):
+        super().__init__(backend, channels, sample_rate, buffer_size, ao_args)
+        self.last = np.zeros((len(self.channels), 1))  # Held when the buffer underflows
+        self.underflows = 0
+
+    def write(self, data, timeout=5.0):
+        data = np.asarray(data, dtype=np.float64).reshape(len(self.channels), -1)
+        deadline = time.perf_counter() + timeout
+        while self.running and self.fifo.space < data.shape[1]:
+            if time.perf_counter() > deadline:
+                raise SimulatedDAQError("Timed out writing to the simulated AO buffer")
+            time.sleep(0.001)
+        self.fifo.put(data)
+        return data.shape[1]
+
+    def space_avail(self):
+        return self.fifo.space
+
+
+class SimBackend:
+    """Software stand-in for an NI board.
+
+    A timer thread advances a sample clock at the tasks' sample_rate, draining the AO buffer and filling the AI buffer,
+    and fires the every n samples callbacks from that thread like the driver does. AI channels named like the
+    loopback_debug ones ('/_ao0_vs_aognd') return the matching AO channel, other AI channels return either the AO
+    x channel looped back (mode='loopback') or a synthetic specimen imaged at the AO (x, y) position (mode='specimen').
+
+    Faults can be injected: overrun_rate and late_rate are per-callback probabilities of losing the AI buffer contents
+    or of delaying the callback by late_by seconds, and inject_overrun() forces an overrun on the next AI read.
+    """
+    product_type = 'Simulated DAQ'
+    ao_min_rate = 1
+    ao_max_rate = 2_000_000
+    ai_max_aggregate_rate = 8_000_000
+
+    def __init__(self, mode='specimen', noise=0.02, overrun_rate=0.0, late_rate=0.0, late_by=0.05, tick=0.002,
+                 realtime=True, seed=None, print_errors=True):
+        self.mode = mode
+        self.noise = noise
+        self.overrun_rate = overrun_rate
+        self.late_rate = late_rate
+        self.late_by = late_by
+        self.tick = tick
+        self.realtime = realtime  # If False no clock thread is started, call advance() to step the simulation
+        self.rng = np.random.default_rng(seed)
+
+        self.ai = None
+        self.ao = None
+        self.voltages = None  # Last static voltages set with set_voltages
+        self.samples = 0  # Samples clocked since the clock started
+        self.callback_errors = []
+        self.print_errors = print_errors
+
+        self._lock = threading.RLock()
+        self._thread = None
+        self._running = False
+
+        # Synthetic specimen, a few gaussian 'cells' (x, y, radius, brightness) in volts of galvo deflection
+        n_cells = 40
+        self.cells = np.column_stack((self.rng.uniform(-2.5, 2.5, (n_cells, 2)),
+                                      self.rng.uniform(0.03, 0.15, n_cells),
+                                      self.rng.uniform(1, 8, n_cells)))
+
+    def ai_max_rate(self, n_channels=1):
+        return self.ai_max_aggregate_rate
+
+    def create_ai_task(self, channels, sample_rate, buffer_size, start_trigger=None, **ai_args):
+        self.ai = SimAITask(self, channels, sample_rate, buffer_size, start_trigger=start_trigger, **ai_args)
+        return self.ai
+
+    def create_ao_task(self, channels, sample_rate, buffer_size, **ao_args):
+        self.ao = SimAOTask(self, channels, sample_rate, buffer_size, **ao_args)
+        return self.ao
+
+    def set_voltages(self, channels, voltages, **ao_args):
+        self.voltages = np.asarray(voltages, dtype=np.float64)
+
+    def inject_overrun(self):
+        if self.ai is not None:
+            self.ai.overrun = True
+
+    # Clock
+    @property
+    def sample_rate(self):
+        task = self.ao if self.ao is not None else self.ai
+        return task.sample_rate
+
+    def _task_started(self, task):
+        # AI with a start trigger waits for AO, starting AO starts the clock for both
+        if task is self.ai and task.start_trigger is not None and not (self.ao is not None and self.ao.running):
+            return
+        self._start_clock()
+
+    def _task_stopped(self, task):
+        if not any(t is not None and t.running for t in (self.ai, self.ao)):
+            self._stop_clock()
+
+    def _task_closed(self, task):
+        if task is self.ai:
+            self.ai = None
+        elif task is self.ao:
+            self.ao = None
+
+    def _start_clock(self):
+        if self._running:
+            return
+        self._running = True
+        self.samples = 0
+        if self.realtime:
+            self._thread = threading.Thread(target=self._run_clock, name='SimDAQClock', daemon=True)
+            self._thread.start()
+
+    def _stop_clock(self):
+        self._running = False
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join()
+        self._thread = None
+
+    def _run_clock(self):
+        t0 = time.perf_counter()
+        while self._running:
+            target = int((time.perf_counter() - t0) * self.sample_rate)
+            if target > self.samples:
+                self.advance(target - self.samples)
+            time.sleep(self.tick)
+
+    def advance(self, nsamples):
+        """Clock nsamples through the running tasks, firing callbacks at their every n samples boundaries"""
+        with self._lock:
+            while nsamples > 0 and self._running:
+                step = nsamples
+                for task in (self.ao, self.ai):
+                    if task is not None and task.running and task.every_n:
+                        step = min(step, task.every_n - task.counter % task.every_n)
+                self._clock(step)
+                nsamples -= step
+
+    def _clock(self, n):
+        ao, ai = self.ao, self.ai
+        out = None
+        if ao is not None and ao.running:
+            out = np.empty((len(ao.channels), n))
+            got = ao.fifo.get(out)
+            if got < n:  # AO buffer ran dry, the real board would error out here
+                ao.underflows += 1
+                out[:, got:] = out[:, got - 1:got] if got else ao.last
+            ao.last = out[:, -1:]
+        if ai is not None and ai.running:
+            if ai.fifo.put(self._ai_signal(ai, out, n)):
+                ai.overrun = True
+        self.samples += n
+
+        for task in (ao, ai):
+            if task is None or not task.running:
+                continue
+            task.counter += n
+            if task.every_n and task.counter % task.every_n == 0:
+                self._fire(task)
+
+    def _fire(self, task):
+        if task is self.ai and self.overrun_rate and self.rng.random() < self.overrun_rate:
+            task.overrun = True
+        if self.late_rate and self.rng.random() < self.late_rate:
+            time.sleep(self.late_by)
+        try:
+            task.callback(0, None, task.every_n, None)
+        except Exception as e:  # The driver swallows callback exceptions too, keep the clock running
+            self.callback_errors.append(e)
+            if self.print_errors:
+                print(f"Simulated DAQ callback error: {e!r}")
+
+    def _ai_signal(self, ai, out, n):
+        if out is None:
+            out = np.zeros((2, n)) if self.voltages is None else np.repeat(self.voltages[:2, None], n, axis=1)
+        signal = np.empty((len(ai.channels), n))
+        for i, ch in enumerate(ai.channels):
+            loopback = re.search(r'_ao(\d+)', ch)
+            if loopback:
+                signal[i] = out[int(loopback.group(1))]
+            elif self.mode == 'loopback':
+                signal[i] = out[0]
+            else:
+                signal[i] = self.specimen(out[0], out[1])
+        if self.noise:
+            signal += self.rng.normal(0, self.noise, signal.shape)
+        lo, hi = ai.args.get('min_val', -10), ai.args.get('max_val', 10)
+        return np.clip(signal, lo, hi, out=signal)
+
+    def specimen(self, x, y):
+        """Synthetic sample brightness (volts) at galvo position (x, y)"""
+        brightness = np.zeros(np.shape(x))
+        for x0, y0, r, b in self.cells:
+            brightness += b * np.exp(-((x - x0) ** 2 + (y - y0) ** 2) / (2 * r ** 2))
+        return brightness
@@ -0,0 +1,78 @@
+import numpy as np
+
+
+class FrameRing:
+    """Fixed-capacity ring of preallocated frame slots.
+
+    The acquisition callback fills the slot returned by acquire() in place and then calls publish(), so no memory is
+    allocated per frame. Consumers get read-only views tagged with a sequence number; a view stays valid until the
+    ring wraps around and the slot is reused, which can be checked with valid(seq).
+    """
+
+    def __init__(self, capacity, shape, dtype=np.float32):
+        self.capacity = capacity
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.buffer = np.zeros((capacity,) + self.shape, dtype=self.dtype)
+        self.seqs = np.full(capacity, -1, dtype=np.int64)  # Sequence number held by each slot, -1 while being filled
+
+        self._views = []
+        for slot in self.buffer:
+            view = slot.view()
+            view.flags.writeable = False
+            self._views.append(view)
+
+        self.next_seq = 0
+        self.latest_seq = -1
+
+    @property
+    def nbytes(self):
+        return self.buffer.nbytes
+
+    def acquire(self):
+        """Returns the writable slot for the next frame, invalidating whatever it held before"""
+        slot = self.next_seq % self.capacity
+        self.seqs[slot] = -1
+        return self.buffer[slot]
+
+    def publish(self):
+        """Marks the slot returned by acquire() as complete, returns (seq, read-only view)"""
+        seq = self.next_seq
+        slot = seq % self.capacity
+        self.seqs[slot] = seq
+        self.latest_seq = seq
+        self.next_seq += 1
+        return seq, self._views[slot]
+
+    def current(self):
+        """(seq, read-only view) of the slot currently being filled, for showing partial frames"""
+        return self.next_seq, self._views[self.next_seq % self.capacity]
+
+    def readable(self, seq):
+        """True if seq is published and not yet overwritten, or is the frame currently being filled"""
+        return seq == self.next_seq or self.valid(seq)
+
+    def valid(self, seq):
+        return seq >= 0 and self.seqs[seq % self.capacity] == seq
+
+    def get(self, seq):
+        """Read-only view of frame seq, or None if it has already been overwritten"""
+        if not self.valid(seq):
+            return None
+        return self._views[seq % self.capacity]
+
+    def latest(self):
+        """(seq, read-only view) of the most recently published frame, or (-1, None) before the first frame"""
+        return self.latest_seq, self.get(self.latest_seq)
+
+    def copy_frame(self, seq, out):
+        """Copy frame seq into out, returns False if it was overwritten before or during the copy"""
+        if not self.valid(seq):
+            return False
+        np.copyto(out, self._views[seq % self.capacity])
+        return self.valid(seq)
+
+    def reset(self):
+        self.seqs[:] = -1
+        self.next_seq = 0
+        self.latest_seq = -1
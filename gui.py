@@ -1,21 +1,73 @@
+import os
+import tempfile
+import threading
+import time
+
+_T0 = time.perf_counter()  # Before the heavy imports, for the startup report
+
 import numpy as np
 import pyqtgraph as pg
 from PyQt5 import QtWidgets, QtCore
 from superqt import QLabeledDoubleRangeSlider, QLabeledDoubleSlider, QLabeledSlider
-from skimage import io
-import nidaqmx
 
+from assembly import BIN_MODES
+from metrics import StartupTimer
+from processing import (BackgroundSubtract, ExponentialAverage, GaussianDenoise, KalmanAverage, MedianDenoise,
+                        ProcessingPipeline, RunningAverage)
+from trajectories import RasterScan, RectROI
 from wavegenbase import WaveformGen
 
+pg.setConfigOptions(imageAxisOrder='row-major')  # Frames are (y, x)
+
+
+class FrameMailbox:
+    """Single-slot 'latest frame' mailbox between the acquisition thread and the GUI thread.
+
+    publish() never blocks the acquisition callback for longer than a lock swap, an unread frame is simply replaced
+    (and counted as dropped) when a newer one arrives.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._item = None
+        self.published = 0
+        self.taken = 0
+        self.dropped = 0
+
+    def publish(self, seq, frame):
+        with self._lock:
+            if self._item is not None:
+                self.dropped += 1
+            self._item = (seq, frame)
+            self.published += 1
+
+    def take(self):
+        """Returns (seq, frame) of the latest unread frame, or None"""
+        with self._lock:
+            item, self._item = self._item, None
+        if item is not None:
+            self.taken += 1
+        return item
+
+    def reset(self):
+        with self._lock:
+            self._item = None
+            self.published = self.taken = self.dropped = 0
 
-class WaveformGUI(QtWidgets.QWidget):
-    def __init__(self, devname='auto', sample_rate=20000):
-        if devname == 'auto':  # Take the first attached/running NI box
-            devname = nidaqmx.system.System.local().devices.device_names[0]
 
+class WaveformGUI(QtWidgets.QWidget):
+    def __init__(self, devname='auto', sample_rate=20000, max_display_fps=30, max_display_size=512, ai_channels=None,
+                 startup=None):
+        # devname='sim' runs the GUI against the software DAQ simulator, 'auto' takes the first attached/running NI box
+        # startup is a StartupTimer the window's own startup steps are added to, reported once it's ready
+        self.startup = startup if startup is not None else StartupTimer()
         super(WaveformGUI, self).__init__()
         self.sample_rate = sample_rate
-        self.wavegen = WaveformGen(devname=devname, sample_rate=self.sample_rate)
+        with self.startup.step('connect to DAQ'):
+            self.wavegen = WaveformGen(devname=devname, sample_rate=self.sample_rate)
+        t_build = time.perf_counter()
+        if ai_channels is not None:  # e.g. ['/ai0', '/ai1'] for two PMTs
+            self.wavegen.ai_channels = list(ai_channels)
 
         # Build the QT gui elements
         self.setWindowTitle('Galvo control')
@@ -102,26 +154,146 @@ class WaveformGUI(QtWidgets.QWidget):
         vbox_control.addWidget(self.samples_per_pixel)
         vbox_control.addSpacing(8)
 
+        self.bidirectional = QtWidgets.QCheckBox("Bidirectional scan")
+        vbox_control.addWidget(self.bidirectional)
+        self.linearize = QtWidgets.QCheckBox("Linearize lines (drop flyback)")
+        vbox_control.addWidget(self.linearize)
+        hbox_phase = QtWidgets.QHBoxLayout()
+        self.line_phase = QtWidgets.QDoubleSpinBox()
+        self.line_phase.setRange(-500, 500)
+        self.line_phase.setSingleStep(0.1)
+        self.line_phase.setDecimals(2)
+        self.line_phase.setSuffix(" samples")
+        self.autophasebutton = QtWidgets.QPushButton("Auto phase")
+        hbox_phase.addWidget(QtWidgets.QLabel("Line phase"))
+        hbox_phase.addWidget(self.line_phase)
+        hbox_phase.addWidget(self.autophasebutton)
+        vbox_control.addLayout(hbox_phase)
+        vbox_control.addSpacing(8)
+
+        self.lines_per_chunk = QtWidgets.QSpinBox()
+        self.lines_per_chunk.setRange(0, 1000)
+        self.lines_per_chunk.setSpecialValueText("Whole frame")
+        vbox_control.addWidget(slider_label("Lines per callback"))
+        vbox_control.addWidget(self.lines_per_chunk)
+        vbox_control.addSpacing(8)
+
+        self.binning = QtWidgets.QComboBox()
+        self.binning.addItems(BIN_MODES)
+        vbox_control.addWidget(slider_label("Pixel binning"))
+        vbox_control.addWidget(self.binning)
+        self.raw = QtWidgets.QCheckBox("Acquire raw int16 counts")
+        vbox_control.addWidget(self.raw)
+        vbox_control.addSpacing(8)
+
+        # Online processing, off the DAQ callback thread
+        self.averaging = QtWidgets.QComboBox()
+        self.averaging.addItems(['none', 'running', 'exponential', 'kalman'])
+        self.denoise = QtWidgets.QComboBox()
+        self.denoise.addItems(['none', 'gaussian', 'median'])
+        self.subtract_background = QtWidgets.QCheckBox("Subtract background")
+        self.backgroundbutton = QtWidgets.QPushButton("Capture background")
+        hbox_processing = QtWidgets.QHBoxLayout()
+        hbox_processing.addWidget(QtWidgets.QLabel("Average"))
+        hbox_processing.addWidget(self.averaging)
+        hbox_processing.addWidget(QtWidgets.QLabel("Denoise"))
+        hbox_processing.addWidget(self.denoise)
+        vbox_control.addLayout(hbox_processing)
+        hbox_background = QtWidgets.QHBoxLayout()
+        hbox_background.addWidget(self.subtract_background)
+        hbox_background.addWidget(self.backgroundbutton)
+        vbox_control.addLayout(hbox_background)
+        self.pipeline = None
+        self.background = BackgroundSubtract()  # Kept across pipeline rebuilds
+        vbox_control.addSpacing(8)
+
         self.fps = QtWidgets.QLabel()
         self.fps.setText("Frames per second: ?")
         vbox_control.addWidget(self.fps)
         vbox_control.addSpacing(10)
 
+        self.max_display_fps = QtWidgets.QSpinBox()
+        self.max_display_fps.setRange(1, 120)
+        self.max_display_fps.setValue(max_display_fps)
+        vbox_control.addWidget(slider_label("Max display FPS"))
+        vbox_control.addWidget(self.max_display_fps)
+        vbox_control.addSpacing(8)
+
+        self.decimate = QtWidgets.QCheckBox(f"Decimate frames larger than {max_display_size} px")
+        self.decimate.setChecked(True)
+        self.max_display_size = max_display_size
+        vbox_control.addWidget(self.decimate)
+        self.show_partial = QtWidgets.QCheckBox("Show partial frames")
+        vbox_control.addWidget(self.show_partial)
+        vbox_control.addSpacing(8)
+
+        self.display_counters = QtWidgets.QLabel()
+        vbox_control.addWidget(self.display_counters)
+        vbox_control.addSpacing(10)
+
+        self.metrics_panel = QtWidgets.QLabel()
+        self.metrics_panel.setStyleSheet("font-family: monospace; font-size: 9pt")
+        vbox_control.addWidget(self.metrics_panel)
+        self.metrics_updated = 0
+        vbox_control.addSpacing(10)
+
         vbox_images = QtWidgets.QVBoxLayout()
         hbox.addLayout(vbox_images)
-        graphics = pg.ImageView()  # QtWidgets.QGraphicsView()
-        graphics.show()
-        graphics.setImage(np.random.random((200, 100)))
-        self.wavegen.reading_image_callback = lambda x: graphics.setImage(x, autoLevels=False, autoHistogramRange=False, levelMode='mono')
-        graphics.view.setAspectLocked(True)
-        # graphics.view.setRange(xRange=[0, 100], yRange=[0, 100], padding=0)
-        graphics.ui.roiBtn.hide()
-        graphics.ui.menuBtn.hide()
-        graphics.getHistogramWidget().setHistogramRange(-20, 20)
-        graphics.setLevels(-15, 15)
-        graphics.setMinimumWidth(600)
-        graphics.setSizePolicy(QtWidgets.QSizePolicy.Expanding, QtWidgets.QSizePolicy.Expanding)
-        vbox_images.addWidget(graphics)
+
+        def image_view():
+            """Helper function for making the image displays"""
+            graphics = pg.ImageView()  # QtWidgets.QGraphicsView()
+            graphics.show()
+            graphics.setImage(np.random.random((100, 200)))
+            graphics.view.setAspectLocked(True)
+            # graphics.view.setRange(xRange=[0, 100], yRange=[0, 100], padding=0)
+            graphics.ui.roiBtn.hide()
+            graphics.ui.menuBtn.hide()
+            graphics.getHistogramWidget().setHistogramRange(-20, 20)
+            graphics.setLevels(-15, 15)
+            graphics.setSizePolicy(QtWidgets.QSizePolicy.Expanding, QtWidgets.QSizePolicy.Expanding)
+            return graphics
+
+        # One display per AI channel, plus an RGB overlay of the first three channels
+        hbox_channels = QtWidgets.QHBoxLayout()
+        vbox_images.addLayout(hbox_channels)
+        self.channel_views = []
+        for ch in self.wavegen.ai_channels:
+            vbox_channel = QtWidgets.QVBoxLayout()
+            vbox_channel.addWidget(QtWidgets.QLabel(ch))
+            graphics = image_view()
+            graphics.setMinimumWidth(600 // len(self.wavegen.ai_channels))
+            vbox_channel.addWidget(graphics)
+            hbox_channels.addLayout(vbox_channel)
+            self.channel_views.append(graphics)
+        self.composite_view = image_view()
+        self.composite_view.setMinimumWidth(600)
+        self.composite_view.hide()
+        vbox_images.addWidget(self.composite_view)
+        self.composite = QtWidgets.QCheckBox("Composite overlay")
+        self.composite.setEnabled(len(self.wavegen.ai_channels) > 1)
+        vbox_images.addWidget(self.composite)
+
+        # Draw a rectangle on the first channel's image and scan just that region
+        self.roi = pg.RectROI([20, 20], [40, 30], pen=pg.mkPen('y', width=2))
+        self.roi.hide()
+        self.channel_views[0].view.addItem(self.roi)
+        hbox_roi = QtWidgets.QHBoxLayout()
+        self.drawroibutton = QtWidgets.QPushButton("Draw ROI")
+        self.drawroibutton.setCheckable(True)
+        self.scanroibutton = QtWidgets.QPushButton("Scan ROI")
+        self.fullframebutton = QtWidgets.QPushButton("Full frame")
+        for button in (self.drawroibutton, self.scanroibutton, self.fullframebutton):
+            hbox_roi.addWidget(button)
+        vbox_images.addLayout(hbox_roi)
+
+        # The acquisition thread only drops frames in the mailbox, rendering happens on the GUI thread in show_latest_frame
+        self.mailbox = FrameMailbox()
+        self.frames_displayed = 0
+        self.display_step = 1  # Decimation of the frame shown, image pixels are display_step frame pixels
+        self.wavegen.reading_image_callback = self.mailbox.publish
+        # Frames still being filled, line by line, only fed while showing partial frames
+        self.lines_mailbox = FrameMailbox()
 
         self.savebutton = QtWidgets.QPushButton("Save last acquisition")
         vbox_images.addWidget(self.savebutton)
@@ -138,32 +310,80 @@ class WaveformGUI(QtWidgets.QWidget):
         # self.plotcurvey = pg.PlotCurveItem(name="Y", pen=pg.mkPen('b', width=3))
         # self.plotwidget.addItem(self.plotcurvey)
 
-        # These controls get disabled during scanning
-        self.state_toggles_widgets = [self.x_amp, self.x_offset, self.y_amp, self.y_offset, self.x_pix, self.samples_per_pixel, self.savebutton]
+        # These controls get disabled during scanning, scan parameters can be changed live
+        self.state_toggles_widgets = [self.savebutton]
 
         # Connect buttons and sliders to the matching functions
         for slider in [self.x_amp, self.x_offset, self.y_amp, self.y_offset, self.x_pix, self.samples_per_pixel]:
             slider.valueChanged.connect(self.update)
         self.startstopbutton.clicked.connect(self.startstop)
         self.zerobutton.clicked.connect(self.wavegen.zero_output)
+        self.binning.currentIndexChanged.connect(self.update)
+        self.lines_per_chunk.valueChanged.connect(self.update)
+        self.raw.toggled.connect(self.update)
+        self.averaging.currentIndexChanged.connect(self.set_processing)
+        self.denoise.currentIndexChanged.connect(self.set_processing)
+        self.subtract_background.toggled.connect(self.set_processing)
+        self.backgroundbutton.clicked.connect(self.capture_background)
+        self.drawroibutton.toggled.connect(self.roi.setVisible)
+        self.scanroibutton.clicked.connect(self.scan_roi)
+        self.fullframebutton.clicked.connect(self.full_frame)
+        self.show_partial.toggled.connect(self.toggle_partial)
+        self.bidirectional.toggled.connect(self.update)
+        self.linearize.toggled.connect(self.update)
+        self.line_phase.valueChanged.connect(self.wavegen.set_line_phase)  # Can be tuned while scanning
+        self.autophasebutton.clicked.connect(self.auto_phase)
+        self.composite.toggled.connect(self.toggle_composite)
         self.savebutton.clicked.connect(self.save)
+        self.max_display_fps.valueChanged.connect(self.update_display_timer)
+
+        self.display_timer = QtCore.QTimer(self)
+        self.display_timer.timeout.connect(self.show_latest_frame)
+        self.update_display_timer()
+        self.display_timer.start()
 
         self.update()
 
         self.setGeometry(50, 50, 1400, 1000)
         self.show()
         self.started = False
-        self.lastacqframes = []
+        self.lastacq = None  # FrameRecorder of the last acquisition, streamed to a temp file until saved
+        self.startup.record('build window', t_build)
+
+        # The waveform (and the scipy import it needs) and the frame buffers are prepared on a thread while the window
+        # paints, the startup report is printed once both are done
+        self._startup_pending = 2
+        self._startup_lock = threading.Lock()
+        self._preparing = threading.Thread(target=self._prepare, name='prepare', daemon=True)
+        self._preparing.start()
+        t_paint = time.perf_counter()
+        QtCore.QTimer.singleShot(0, lambda: self._startup_done('first paint', t_paint))
+
+    def _prepare(self):
+        t0 = time.perf_counter()
+        try:
+            self.wavegen.prepare()
+        finally:
+            self._startup_done('prepare waveform and buffers', t0)
+
+    def _startup_done(self, step, t0):
+        self.startup.record(step, t0)
+        with self._startup_lock:
+            self._startup_pending -= 1
+            if self._startup_pending == 0:
+                print(self.startup.report())
 
     def update(self):
-        # Give updated values to the wavegen object
-        self.wavegen.x_amp = self.x_amp.value()
-        self.wavegen.x_offset = self.x_offset.value()
-        self.wavegen.y_amp = self.y_amp.value()
-        self.wavegen.y_offset = self.y_offset.value()
-        self.wavegen.pixels_x = self.x_pix.value()
-        self.wavegen.samples_per_pixel = self.samples_per_pixel.value()
-        self.y_pix_lbl.setText(f"# Y Pixels: {self.wavegen.pixels_y}")
+        # Give updated values to the wavegen object, applied live if scanning
+        self.wavegen.update_params(x_amp=self.x_amp.value(), x_offset=self.x_offset.value(),
+                                   y_amp=self.y_amp.value(), y_offset=self.y_offset.value(),
+                                   pixels_x=self.x_pix.value(), samples_per_pixel=self.samples_per_pixel.value(),
+                                   binning=self.binning.currentText(), bidirectional=self.bidirectional.isChecked(),
+                                   lines_per_chunk=self.lines_per_chunk.value() or None, raw=self.raw.isChecked(),
+                                   linearize=self.linearize.isChecked())
+        self.line_phase.setEnabled(self.wavegen.bidirectional)
+        self.autophasebutton.setEnabled(self.wavegen.bidirectional)
+        self.y_pix_lbl.setText(f"# Y Pixels: {self.wavegen.frame_rows}")
         self.fps.setText(f"Frames per second: {self.wavegen.fps:0.2f}")
 
         #update wavedisp
@@ -173,6 +393,133 @@ class WaveformGUI(QtWidgets.QWidget):
         # self.plotcurveamp.setData(samp_time, pcdata)
         # self.plotwidget.setXRange(0, timeperiod * 1.1)
 
+    def update_display_timer(self):
+        self.display_timer.setInterval(round(1000 / self.max_display_fps.value()))
+
+    def toggle_composite(self, checked):
+        self.composite_view.setVisible(checked)
+        for graphics in self.channel_views:
+            graphics.setVisible(not checked)
+
+    def set_processing(self):
+        """Rebuild the processing pipeline from the controls, frames go straight to the display without one"""
+        if self.pipeline is not None:
+            self.wavegen.pipeline = None
+            self.pipeline.stop()
+            self.pipeline = None
+        operators = []
+        if self.subtract_background.isChecked():
+            operators.append(self.background)
+        averaging = self.averaging.currentText()
+        if averaging != 'none':
+            operators.append({'running': RunningAverage, 'exponential': ExponentialAverage,
+                              'kalman': KalmanAverage}[averaging]())
+        denoise = self.denoise.currentText()
+        if denoise != 'none':
+            operators.append({'gaussian': GaussianDenoise, 'median': MedianDenoise}[denoise]())
+        self.mailbox.reset()
+        if not operators:
+            self.wavegen.reading_image_callback = self.mailbox.publish
+            return
+        self.wavegen.reading_image_callback = None
+        self.pipeline = ProcessingPipeline(operators)
+        self.pipeline.on_frame = self.mailbox.publish
+        self.pipeline.start()
+        self.wavegen.pipeline = self.pipeline
+
+    def scan_roi(self):
+        """Switch to a raster of the rectangle drawn on the image, at the current pixel count and samples per pixel"""
+        raster = self.wavegen.trajectory
+        if raster is None:
+            raster = RasterScan(self.wavegen.x_amp, self.wavegen.x_offset, self.wavegen.y_amp, self.wavegen.y_offset,
+                                self.wavegen.pixels_x, self.wavegen.pixels_y)
+        elif not isinstance(raster, RasterScan):
+            return  # Line, spiral and point scans aren't images an ROI can be drawn on
+        x0, x1, y0, y1 = raster.extent
+        # The ROI is drawn on the (possibly decimated) image shown
+        (col, row), (width, height) = self.roi.pos() * self.display_step, self.roi.size() * self.display_step
+        # Image columns/rows to volts, rows go up the y ramp
+        to_x = lambda c: x0 + min(max(c, 0), raster.pixels_x) / raster.pixels_x * (x1 - x0)
+        to_y = lambda r: y0 + min(max(r, 0), raster.pixels_y) / raster.pixels_y * (y1 - y0)
+        roi = RectROI(to_x(col), to_y(row), to_x(col + width), to_y(row + height), self.x_pix.value(),
+                      samples_per_pixel=self.samples_per_pixel.value(), sigma=self.wavegen.smoothing_sigma)
+        if roi.x_amp <= 0 or roi.y_amp <= 0:
+            return
+        self.drawroibutton.setChecked(False)
+        self.wavegen.update_params(trajectory=roi)
+        self.update()
+
+    def full_frame(self):
+        self.wavegen.update_params(trajectory=None)
+        self.update()
+
+    def capture_background(self):
+        """Average the next frames into the background (e.g. with the shutter closed) and start subtracting it"""
+        self.background.capture(10)
+        if not self.subtract_background.isChecked():
+            self.subtract_background.setChecked(True)  # Rebuilds the pipeline with the background operator
+
+    def toggle_partial(self, checked):
+        self.lines_mailbox.reset()
+        self.wavegen.reading_lines_callback = self.publish_lines if checked else None
+
+    def publish_lines(self, seq, frame, lines_done):
+        self.lines_mailbox.publish(seq, frame)
+
+    def show_latest_frame(self):
+        item = self.mailbox.take()
+        ring = self.wavegen.ring if self.pipeline is None else self.pipeline.ring
+        if self.show_partial.isChecked():
+            # The partial frame is at least as new as the last complete one
+            partial = self.lines_mailbox.take()
+            if partial is not None:
+                item, ring = partial, self.wavegen.ring
+        if item is not None:
+            seq, frame = item  # (channel, y, x)
+            step = 1
+            if self.decimate.isChecked():
+                step = max(1, -(-max(frame.shape[1:]) // self.max_display_size))
+                if step > 1:
+                    frame = frame[:, ::step, ::step]
+            frame = np.array(frame)  # Copy out of the frame ring, the slot gets reused once the ring wraps around
+            if ring is not None and not ring.readable(seq):  # Overwritten while copying, skip this one
+                self.mailbox.dropped += 1
+            else:
+                frame = self.wavegen.scale_frame(frame)  # Raw counts to volts, only for the (decimated) frames shown
+                if self.composite.isChecked():
+                    self.composite_view.setImage(self.composite_image(frame), autoLevels=False, levels=(0, 1))
+                else:
+                    for graphics, image in zip(self.channel_views, frame):
+                        graphics.setImage(image, autoLevels=False, autoHistogramRange=False, levelMode='mono')
+                self.frames_displayed += 1
+                self.display_step = step
+        ring = self.wavegen.ring
+        acquired = ring.latest_seq + 1 - self.wavegen.start_seq if ring is not None else 0
+        dropped = self.mailbox.dropped
+        if self.pipeline is not None:
+            dropped += self.pipeline.dropped + self.pipeline.overwritten
+        self.display_counters.setText(f"Frames acquired: {max(acquired, 0)}\n"
+                                      f"Frames displayed: {self.frames_displayed}\n"
+                                      f"Frames dropped: {dropped}")
+        if self.started and time.perf_counter() - self.metrics_updated > 0.5:
+            summary = self.wavegen.metrics.summary()
+            if self.pipeline is not None:
+                summary += '\n' + self.pipeline.summary()
+            self.metrics_panel.setText(summary)
+            self.metrics_updated = time.perf_counter()
+
+    def composite_image(self, frame):
+        """RGB (y, x, 3) overlay of up to three channels, each scaled by the levels set on its own display"""
+        rgb = np.zeros(frame.shape[1:] + (3,), dtype=np.float32)
+        for i, (image, graphics) in enumerate(zip(frame[:3], self.channel_views)):
+            lo, hi = graphics.getLevels()
+            rgb[..., i] = (image - lo) / ((hi - lo) or 1)
+        return np.clip(rgb, 0, 1, out=rgb)
+
+    def auto_phase(self):
+        if self.started and self.wavegen.bidirectional:
+            self.line_phase.setValue(self.wavegen.auto_line_phase())
+
     def startstop(self):
         if self.started:
             self.stop()
@@ -184,6 +531,18 @@ class WaveformGUI(QtWidgets.QWidget):
         self.startstopbutton.setText("Scanning")
         self.startstopbutton.setStyleSheet("background-color: red")
         [w.setDisabled(True) for w in self.state_toggles_widgets]
+        if self.lastacq is not None:  # Previous acquisition was never saved
+            self.lastacq.discard()
+        self.mailbox.reset()
+        self.lines_mailbox.reset()
+        if self.pipeline is not None:  # Restart the averages
+            self.pipeline.stop()
+            self.pipeline.start()
+        self.frames_displayed = 0
+        fd, tmppath = tempfile.mkstemp(suffix='.tif', prefix='joe_scan_')
+        os.close(fd)
+        self.wavegen.start_recording(tmppath)
+        self._preparing.join()  # Long done unless Start is hit right away
         self.wavegen.start()
 
     def stop(self):
@@ -191,18 +550,27 @@ class WaveformGUI(QtWidgets.QWidget):
         self.startstopbutton.setText("Start")
         self.startstopbutton.setStyleSheet("")
         [w.setDisabled(False) for w in self.state_toggles_widgets]
-        self.lastacqframes = self.wavegen.frames
-        self.wavegen.stop()  # Stop the tasks as well, since changing the number of pixels requires regenerating the task buffers
-        self.wavegen.close()
+        self.wavegen.stop()  # Tasks stay committed for a quick restart, they're only closed with the window
+        self.lastacq = self.wavegen.stop_recording()
 
-    # def closeEvent(self, event):
-    #     # self.wavegen.close()
-    #     event.accept()
+    def closeEvent(self, event):
+        if self.started:
+            self.stop()
+        self.wavegen.close()
+        if self.pipeline is not None:
+            self.pipeline.stop()
+        if self.lastacq is not None:
+            self.lastacq.discard()
+        event.accept()
 
     def save(self):
-        if self.lastacqframes:
+        if self.lastacq is not None and self.lastacq.written:
             filename = QtWidgets.QFileDialog.getSaveFileName(filter="Tif files (*.tif)")[0]
-            io.imsave(filename, np.stack(self.lastacqframes))
+            if not filename:
+                return
+            # Frames were already streamed to disk during acquisition, so saving is just a rename
+            self.lastacq.finalize(filename)
+            self.lastacq = None
             # msg = QtWidgets.QMessageBox()
             # msg.setIcon(QtWidgets.QMessageBox.Information)
             # msg.setText(f"The last acquisition has been saved to: <b> {filename}</b>")
@@ -222,7 +590,9 @@ class WaveformGUI(QtWidgets.QWidget):
 if __name__ == '__main__':
     import sys
 
+    startup = StartupTimer(t0=_T0)
+    startup.record('imports', _T0)
     app = QtWidgets.QApplication(sys.argv)
     app.setApplicationName('Galvo control')
-    wg = WaveformGUI(devname='auto')
+    wg = WaveformGUI(devname=sys.argv[1] if len(sys.argv) > 1 else 'auto', startup=startup)
     sys.exit(app.exec_())
@@ -0,0 +1,244 @@
+"""Lightweight instrumentation of the DAQ callbacks.
+
+Recording a callback is a few perf_counter/bisect operations, cheap enough to leave on all the time. snapshot() returns
+a plain dict for the GUI, logs or ad-hoc inspection.
+"""
+import bisect
+import contextlib
+import csv
+import json
+import math
+import os
+import threading
+import time
+
+# Histogram bin edges in seconds, 4 per decade from 10 us to 10 s
+HIST_EDGES = [10 ** (e / 4) for e in range(-20, 5)]
+
+
+class CallbackStats:
+    """Wall time histogram and call period jitter of one callback"""
+
+    def __init__(self, nominal_period=None, late_factor=1.5):
+        self.nominal_period = nominal_period
+        self.late_factor = late_factor
+        self.reset()
+
+    def reset(self):
+        self.counts = [0] * (len(HIST_EDGES) + 1)
+        self.calls = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.last_start = None
+        self.late = 0
+        # Welford running mean/variance of the call period
+        self._periods = 0
+        self._period_mean = 0.0
+        self._period_m2 = 0.0
+        self.max_period = 0.0
+
+    def record(self, start, duration):
+        self.counts[bisect.bisect(HIST_EDGES, duration)] += 1
+        self.calls += 1
+        self.total += duration
+        if duration > self.max:
+            self.max = duration
+        if self.last_start is not None:
+            period = start - self.last_start
+            self._periods += 1
+            delta = period - self._period_mean
+            self._period_mean += delta / self._periods
+            self._period_m2 += delta * (period - self._period_mean)
+            if period > self.max_period:
+                self.max_period = period
+            if self.nominal_period and period > self.late_factor * self.nominal_period:
+                self.late += 1
+        self.last_start = start
+
+    def percentile(self, q):
+        """Upper bin edge below which a fraction q of the calls fell"""
+        target = q * self.calls
+        seen = 0
+        for count, edge in zip(self.counts, HIST_EDGES + [math.inf]):
+            seen += count
+            if seen >= target and seen:
+                return edge
+        return None
+
+    def snapshot(self):
+        jitter = math.sqrt(self._period_m2 / self._periods) if self._periods > 1 else None
+        return {'calls': self.calls,
+                'mean_s': self.total / self.calls if self.calls else None,
+                'p50_s': self.percentile(0.5), 'p99_s': self.percentile(0.99), 'max_s': self.max,
+                'period_mean_s': self._period_mean if self._periods else None, 'period_jitter_s': jitter,
+                'period_max_s': self.max_period, 'nominal_period_s': self.nominal_period, 'late': self.late,
+                'histogram': {'edges_s': HIST_EDGES, 'counts': list(self.counts)}}
+
+
+class HotPathMetrics:
+    """Callback timing, buffer headroom, AO vs AI drift and fault counts of a WaveformGen.
+
+    The callbacks fire once per chunk (WaveformGen.chunk_lines lines), so the drift is counted in chunks.
+    """
+
+    def __init__(self):
+        self.ao = CallbackStats()
+        self.ai = CallbackStats()
+        self.reset()
+
+    def reset(self, nominal_period=None, ai_buffer=None, ao_buffer=None, expected_drift=0):
+        self.ao.nominal_period = self.ai.nominal_period = nominal_period
+        self.ao.reset()
+        self.ai.reset()
+        self.ai_buffer = ai_buffer  # samples per channel
+        self.ao_buffer = ao_buffer
+        self.ai_headroom = self.ai_headroom_min = None  # free samples left in the AI buffer before it overruns
+        self.ao_headroom = self.ao_headroom_min = None  # samples still queued in the AO buffer before it underflows
+        self.ao_chunks = self.ai_chunks = 0  # callbacks
+        self.expected_drift = expected_drift  # AO runs ahead by the chunks primed into its buffer
+        self.max_drift = 0
+        self.overruns = 0
+        self.underflows = 0
+        self.started = time.time()
+
+    def record_ai(self, start, duration, avail):
+        self.ai.record(start, duration)
+        self.ai_chunks += 1
+        if avail is not None and self.ai_buffer:
+            self.ai_headroom = self.ai_buffer - avail
+            if self.ai_headroom_min is None or self.ai_headroom < self.ai_headroom_min:
+                self.ai_headroom_min = self.ai_headroom
+        self._drift()
+
+    def record_ao(self, start, duration, space):
+        self.ao.record(start, duration)
+        self.ao_chunks += 1
+        if space is not None and self.ao_buffer:
+            self.ao_headroom = self.ao_buffer - space
+            if self.ao_headroom_min is None or self.ao_headroom < self.ao_headroom_min:
+                self.ao_headroom_min = self.ao_headroom
+        self._drift()
+
+    def _drift(self):
+        drift = abs(self.ao_chunks - self.ai_chunks - self.expected_drift)
+        if drift > self.max_drift:
+            self.max_drift = drift
+
+    def snapshot(self):
+        return {'time': time.time(), 'uptime_s': time.time() - self.started,
+                'ao_callback': self.ao.snapshot(), 'ai_callback': self.ai.snapshot(),
+                'ai_buffer': self.ai_buffer, 'ai_headroom': self.ai_headroom, 'ai_headroom_min': self.ai_headroom_min,
+                'ao_buffer': self.ao_buffer, 'ao_headroom': self.ao_headroom, 'ao_headroom_min': self.ao_headroom_min,
+                'ao_chunks': self.ao_chunks, 'ai_chunks': self.ai_chunks,
+                'drift_chunks': self.ao_chunks - self.ai_chunks - self.expected_drift, 'max_drift_chunks': self.max_drift,
+                'late': self.ao.late + self.ai.late, 'overruns': self.overruns, 'underflows': self.underflows}
+
+    def summary(self):
+        """A few lines of text for a status panel"""
+        def ms(v):
+            return f"{v * 1e3:0.2f}" if v is not None else '-'
+
+        s = self.snapshot()
+        ao, ai = s['ao_callback'], s['ai_callback']
+        return (f"AO callback: p50 {ms(ao['p50_s'])} / max {ms(ao['max_s'])} ms, jitter {ms(ao['period_jitter_s'])} ms\n"
+                f"AI callback: p50 {ms(ai['p50_s'])} / max {ms(ai['max_s'])} ms, jitter {ms(ai['period_jitter_s'])} ms\n"
+                f"AI headroom: {s['ai_headroom']} (min {s['ai_headroom_min']}) of {s['ai_buffer']} samples\n"
+                f"AO headroom: {s['ao_headroom']} (min {s['ao_headroom_min']}) of {s['ao_buffer']} samples\n"
+                f"AO-AI drift: {s['drift_chunks']} chunks (max {s['max_drift_chunks']})\n"
+                f"Late: {s['late']}, overruns: {s['overruns']}, underflows: {s['underflows']}")
+
+
+def flatten(d, prefix=''):
+    """Flatten a snapshot into {'ao_callback.p50_s': ...} columns for CSV, dropping the histograms"""
+    flat = {}
+    for k, v in d.items():
+        if k == 'histogram':
+            continue
+        if isinstance(v, dict):
+            flat.update(flatten(v, f"{prefix}{k}."))
+        else:
+            flat[prefix + k] = v
+    return flat
+
+
+class MetricsLog:
+    """Appends a metrics snapshot every interval seconds to a rolling JSONL (or .csv) file, from its own thread.
+
+    Once the file grows past max_bytes it's renamed to path + '.1' (replacing the previous one) and a new file started.
+    """
+
+    def __init__(self, metrics, path, interval=1.0, max_bytes=10_000_000):
+        self.metrics = metrics
+        self.path = path
+        self.interval = interval
+        self.max_bytes = max_bytes
+        self.csv = path.endswith('.csv')
+        self._stop = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, name='MetricsLog', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def write(self):
+        snapshot = self.metrics.snapshot()
+        if os.path.exists(self.path) and os.path.getsize(self.path) > self.max_bytes:
+            os.replace(self.path, self.path + '.1')
+        if self.csv:
+            row = flatten(snapshot)
+            new = not os.path.exists(self.path)
+            with open(self.path, 'a', newline='') as f:
+                writer = csv.DictWriter(f, fieldnames=list(row))
+                if new:
+                    writer.writeheader()
+                writer.writerow(row)
+        else:
+            with open(self.path, 'a') as f:
+                f.write(json.dumps(snapshot) + '\n')
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.write()
+
+
+class StartupTimer:
+    """Where the seconds of startup go: named steps (possibly overlapping, on other threads) relative to t0.
+
+    with timer.step('name'): ... times a step, record() adds one timed elsewhere, report() is a small table.
+    """
+
+    def __init__(self, t0=None):
+        self.t0 = time.perf_counter() if t0 is None else t0
+        self.steps = []  # (name, start, end) seconds since t0
+        self._lock = threading.Lock()
+
+    def record(self, name, start, end=None):
+        end = time.perf_counter() if end is None else end
+        with self._lock:
+            self.steps.append((name, start - self.t0, end - self.t0))
+
+    @contextlib.contextmanager
+    def step(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, start)
+
+    def snapshot(self):
+        return {name: {'start_s': start, 'duration_s': end - start} for name, start, end in self.steps}
+
+    def report(self):
+        width = max([len(name) for name, _, _ in self.steps] + [4])
+        lines = [f"{'Step':<{width}}  {'start':>8}  {'took':>8}"]
+        for name, start, end in sorted(self.steps, key=lambda s: s[1]):
+            lines.append(f"{name:<{width}}  {start * 1e3:>6.0f}ms  {(end - start) * 1e3:>6.0f}ms")
+        total = max(end for _, _, end in self.steps) if self.steps else 0
+        lines.append(f"{'Total':<{width}}  {'':>8}  {total * 1e3:>6.0f}ms")
+        return '\n'.join(lines)
@@ -0,0 +1,371 @@
+"""Online processing of the acquired frames, off the DAQ callback thread.
+
+A ProcessingPipeline sits between WaveformGen.reading_task_callback and the frame consumers (display, subscribers).
+The callback only queues (FrameRing, seq) with submit(), which never blocks. Worker threads copy the frame out of the
+ring into a float32 work frame, run it through the operators in place, and publish the result into the pipeline's own
+FrameRing and on_frame callback. numpy and scipy.ndimage release the GIL, so the workers do run in parallel with each
+other and with the DAQ callbacks.
+
+Operators are callables working in place on a (channel, y, x) float32 frame. Stateful ones (the averages) set
+stateful = True, they see the frames one at a time and in acquisition order even with several workers, while
+stateless ones (denoise) run on several frames at once. Frames also leave the pipeline in order.
+
+When the workers fall behind the bounded queue fills up, drop='oldest' then discards the oldest queued frame (lowest
+latency, the default for live display) and drop='newest' the incoming one (keeps the averages' input evenly spaced).
+"""
+import collections
+import threading
+import time
+
+import numpy as np
+
+from framering import FrameRing
+from metrics import CallbackStats
+
+DROP_POLICIES = ('oldest', 'newest')
+
+
+class RunningAverage:
+    """Cumulative mean of all frames since reset, updated in place. With window set the weight of a new frame
+    stops shrinking after window frames, so the average keeps following slow changes"""
+    name = 'running_average'
+    stateful = True
+
+    def __init__(self, window=None):
+        self.window = window
+        self.reset()
+
+    def reset(self):
+        self.mean = None
+        self.count = 0
+
+    def __call__(self, frame):
+        if self.mean is None or self.mean.shape != frame.shape:
+            self.mean = frame.copy()
+            self.count = 1
+            return frame
+        if self.window is None or self.count < self.window:
+            self.count += 1
+        frame -= self.mean
+        frame /= self.count
+        self.mean += frame
+        np.copyto(frame, self.mean)
+        return frame
+
+
+class ExponentialAverage:
+    """Exponentially weighted moving average, each new frame gets weight alpha"""
+    name = 'exponential_average'
+    stateful = True
+
+    def __init__(self, alpha=0.1):
+        self.alpha = alpha
+        self.reset()
+
+    def reset(self):
+        self.mean = None
+
+    def __call__(self, frame):
+        if self.mean is None or self.mean.shape != frame.shape:
+            self.mean = frame.copy()
+            return frame
+        frame -= self.mean
+        frame *= self.alpha
+        self.mean += frame
+        np.copyto(frame, self.mean)
+        return frame
+
+
+class KalmanAverage:
+    """Recursive Kalman filter over frames, as in ImageJ's Kalman Stack Filter.
+
+    gain (0-1) weighs the prediction against the new frame, noise_variance is the assumed measurement noise. The
+    filter gain starts high and settles as the estimate's variance shrinks, so the first frames update it quickly.
+    """
+    name = 'kalman_average'
+    stateful = True
+
+    def __init__(self, gain=0.8, noise_variance=0.05):
+        self.gain = gain
+        self.noise_variance = noise_variance
+        self.reset()
+
+    def reset(self):
+        self.estimate = None
+        self.variance = self.noise_variance
+
+    def __call__(self, frame):
+        if self.estimate is None or self.estimate.shape != frame.shape:
+            self.estimate = frame.copy()
+            self.variance = self.noise_variance
+            return frame
+        kalman = self.variance / (self.variance + self.noise_variance)
+        # estimate = gain * estimate + (1 - gain) * frame + kalman * (frame - estimate)
+        frame -= self.estimate
+        frame *= (1 - self.gain) + kalman
+        self.estimate += frame
+        self.variance *= 1 - kalman
+        np.copyto(frame, self.estimate)
+        return frame
+
+
+class BackgroundSubtract:
+    """Subtracts a dark/background frame. capture(n) averages the next n frames into the background"""
+    name = 'background_subtract'
+    stateful = True
+
+    def __init__(self, background=None):
+        self.background = None if background is None else np.asarray(background, dtype=np.float32)
+        self._capture = 0
+        self._captured = 0
+        self._sum = None
+
+    def reset(self):
+        pass  # The background outlives restarts
+
+    def capture(self, n_frames=10):
+        self._captured = 0
+        self._sum = None
+        self._capture = n_frames
+
+    @property
+    def capturing(self):
+        return self._capture > 0
+
+    def __call__(self, frame):
+        if self._capture:
+            if self._sum is None or self._sum.shape != frame.shape:
+                self._sum = np.zeros(frame.shape, dtype=np.float64)
+            self._sum += frame
+            self._captured += 1
+            if self._captured == self._capture:
+                self.background = (self._sum / self._captured).astype(np.float32)
+                self._capture = 0
+                self._sum = None
+        if self.background is not None and self.background.shape == frame.shape:
+            frame -= self.background
+        return frame
+
+
+class GaussianDenoise:
+    """Gaussian blur of each channel, sigma in pixels"""
+    name = 'gaussian_denoise'
+    stateful = False
+
+    def __init__(self, sigma=1.0):
+        self.sigma = sigma
+
+    def reset(self):
+        pass
+
+    def __call__(self, frame):
+        from scipy import ndimage  # Loaded with the first frame rather than at startup
+        for plane in frame:
+            np.copyto(plane, ndimage.gaussian_filter(plane, self.sigma, mode='nearest'))
+        return frame
+
+
+class MedianDenoise:
+    """size x size median filter of each channel, removes shot noise spikes while keeping edges"""
+    name = 'median_denoise'
+    stateful = False
+
+    def __init__(self, size=3):
+        self.size = size
+
+    def reset(self):
+        pass
+
+    def __call__(self, frame):
+        from scipy import ndimage
+        for plane in frame:
+            np.copyto(plane, ndimage.median_filter(plane, size=self.size, mode='nearest'))
+        return frame
+
+
+class _Turnstile:
+    """Lets frames through in ticket order. Tickets that will never arrive (dropped mid-pipeline) are skipped"""
+
+    def __init__(self, stopping):
+        self.cond = threading.Condition()
+        self.next = 0
+        self.skipped = set()
+        self.stopping = stopping
+
+    def wait(self, ticket):
+        with self.cond:
+            while ticket != self.next:
+                if self.stopping.is_set():
+                    return False
+                self.cond.wait(0.1)
+        return True
+
+    def done(self, ticket):
+        with self.cond:
+            self.next = ticket + 1
+            while self.next in self.skipped:
+                self.skipped.remove(self.next)
+                self.next += 1
+            self.cond.notify_all()
+
+    def skip(self, ticket):
+        with self.cond:
+            if ticket == self.next:
+                self.done(ticket)
+            else:
+                self.skipped.add(ticket)
+
+
+class ProcessingPipeline:
+    """Runs frames through operators on a pool of worker threads, see the module docstring.
+
+    Processed frames are published into self.ring (float32, the same (channel, y, x) shape) and passed to
+    on_frame(seq, read-only view), seq being the pipeline ring's sequence number.
+    """
+
+    def __init__(self, operators, workers=2, queue_size=4, drop='oldest', ring_capacity=16):
+        assert drop in DROP_POLICIES, f"Unknown drop policy {drop}, pick one of {DROP_POLICIES}"
+        self.operators = list(operators)
+        self.n_workers = workers
+        self.queue_size = queue_size
+        self.drop = drop
+        self.ring_capacity = ring_capacity
+        self.ring = None
+        self.on_frame = None
+
+        self._queue = collections.deque()
+        self._cond = threading.Condition()
+        self._stopping = threading.Event()
+        self._threads = []
+        self.timings = [CallbackStats() for _ in self.operators]  # Wall time per frame of each operator
+        self.latency = CallbackStats()  # submit to publish
+        self.reset()
+
+    def reset(self):
+        """Clear the counters, timings and operator state (e.g. the averages)"""
+        self.submitted = 0
+        self.processed = 0
+        self.dropped = 0  # Discarded by the drop policy
+        self.overwritten = 0  # Reused in the source ring before a worker got to copy it
+        self.errors = 0
+        self.last_error = None
+        for op in self.operators:
+            op.reset()
+        for stats in self.timings:
+            stats.reset()
+        self.latency.reset()
+        self._next_ticket = 0
+        self._gates = [_Turnstile(self._stopping) if op.stateful else None for op in self.operators]
+        self._output_gate = _Turnstile(self._stopping)
+
+    def start(self):
+        self._stopping.clear()
+        self._threads = [threading.Thread(target=self._run, name=f'ProcessingPipeline-{i}', daemon=True)
+                         for i in range(self.n_workers)]
+        for thread in self._threads:
+            thread.start()
+
+    def stop(self):
+        """Stop the workers, frames still queued are discarded"""
+        self._stopping.set()
+        with self._cond:
+            self._cond.notify_all()
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+        with self._cond:
+            self._queue.clear()
+        self.reset()
+
+    def submit(self, ring, seq):
+        """Queue frame seq of a FrameRing, called from the DAQ callback. Returns False if a frame was dropped"""
+        with self._cond:
+            self.submitted += 1
+            dropped = len(self._queue) >= self.queue_size
+            if dropped:
+                self.dropped += 1
+                if self.drop == 'newest':
+                    return False
+                self._queue.popleft()
+            self._queue.append((time.perf_counter(), ring, seq))
+            self._cond.notify()
+        return not dropped
+
+    def _run(self):
+        work = None
+        while True:
+            with self._cond:
+                while not self._queue and not self._stopping.is_set():
+                    self._cond.wait()
+                if self._stopping.is_set():
+                    return
+                submitted, ring, seq = self._queue.popleft()
+                ticket = self._next_ticket
+                self._next_ticket += 1
+
+            if work is None or work.shape != ring.shape:
+                work = np.empty(ring.shape, dtype=np.float32)
+            if not ring.copy_frame(seq, work):
+                self.overwritten += 1
+                self._skip(ticket, 0)
+                continue
+            if not self._process(ticket, work):
+                continue
+            if not self._output_gate.wait(ticket):
+                return
+            try:
+                self._publish(work, submitted)
+            finally:
+                self._output_gate.done(ticket)
+
+    def _process(self, ticket, work):
+        for i, (op, gate, stats) in enumerate(zip(self.operators, self._gates, self.timings)):
+            if gate is not None and not gate.wait(ticket):
+                return False
+            t0 = time.perf_counter()
+            try:
+                op(work)
+            except Exception as e:  # Keep the pipeline going, the frame is lost
+                self.errors += 1
+                self.last_error = e
+                self._skip(ticket, i + 1)
+                return False
+            finally:
+                stats.record(t0, time.perf_counter() - t0)
+                if gate is not None:
+                    gate.done(ticket)
+        return True
+
+    def _skip(self, ticket, first_op):
+        for gate in self._gates[first_op:]:
+            if gate is not None:
+                gate.skip(ticket)
+        self._output_gate.skip(ticket)
+
+    def _publish(self, work, submitted):
+        if self.ring is None or self.ring.shape != work.shape:
+            self.ring = FrameRing(self.ring_capacity, work.shape, dtype=np.float32)
+        np.copyto(self.ring.acquire(), work)
+        seq, frame = self.ring.publish()
+        self.processed += 1
+        now = time.perf_counter()
+        self.latency.record(now, now - submitted)
+        if self.on_frame:
+            self.on_frame(seq, frame)
+
+    def snapshot(self):
+        return {'submitted': self.submitted, 'processed': self.processed, 'dropped': self.dropped,
+                'overwritten': self.overwritten, 'errors': self.errors, 'queued': len(self._queue),
+                'latency': self.latency.snapshot(),
+                'operators': {op.name: stats.snapshot() for op, stats in zip(self.operators, self.timings)}}
+
+    def summary(self):
+        """A few lines of text for a status panel"""
+        def ms(v):
+            return f"{v * 1e3:0.2f}" if v is not None else '-'
+
+        lines = [f"{op.name}: p50 {ms(stats.percentile(0.5))} / max {ms(stats.max)} ms"
+                 for op, stats in zip(self.operators, self.timings)]
+        lines.append(f"Latency: p50 {ms(self.latency.percentile(0.5))} / max {ms(self.latency.max)} ms")
+        lines.append(f"Processed: {self.processed}, dropped: {self.dropped + self.overwritten}, errors: {self.errors}")
+        return '\n'.join(lines)
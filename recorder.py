@@ -0,0 +1,132 @@
+import os
+import queue
+import shutil
+import threading
+import time
+
+import numpy as np
+
+
+class FrameRecorder:
+    """Streams frames to a BigTIFF file from a background writer thread.
+
+    The acquisition side only does a non-blocking put onto a bounded queue, so a slow disk can never stall the DAQ
+    callbacks. If the queue is full the frame is dropped and counted, and frames that reach the disk more than
+    late_after seconds after they were pushed are counted as late.
+
+    A change of frame shape mid-recording (e.g. pixels_x changed while scanning) starts a new series in the file, and
+so does new metadata given with set_metadata, from the next frame pushed on.
+
+    Frames can be pushed either as arrays, or as (FrameRing, seq) with push_slot, in which case the slot is copied out
+    of the ring on the writer thread and frames the ring overwrote before they could be written count as dropped.
+
+    With max_frames set, frames pushed after the first max_frames are ignored (and not counted as dropped).
+    """
+
+    def __init__(self, path, metadata=None, queue_size=64, late_after=1.0, max_frames=None):
+        self.path = path
+        self.max_frames = max_frames
+        self.metadata = dict(metadata or {})
+        self._new_metadata = self.metadata  # Goes to the writer with the next frame queued
+        self.late_after = late_after
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.thread = None
+
+        self.pushed = 0
+        self.written = 0
+        self.dropped = 0
+        self.late = 0
+        self.max_latency = 0.0
+        self.error = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, name='FrameRecorder', daemon=True)
+        self.thread.start()
+
+    def set_metadata(self, metadata):
+        """Save metadata with the frames pushed from now on, in a new series if it differs from the current one.
+        Call it from the thread that pushes the frames, or while nothing is pushed"""
+        metadata = dict(metadata)
+        if metadata != self.metadata:
+            self.metadata = metadata
+            self._new_metadata = metadata
+
+    def push(self, frame):
+        """Queue a frame for writing. Returns False (and counts a drop) if the writer can't keep up."""
+        return self._put((time.perf_counter(), frame, None, None))
+
+    def push_slot(self, ring, seq):
+        """Queue frame seq of a FrameRing for writing, without copying it on the calling thread"""
+        return self._put((time.perf_counter(), None, ring, seq))
+
+    def _put(self, item):
+        if self.max_frames is not None and self.pushed >= self.max_frames:
+            return False
+        self.pushed += 1
+        try:
+            self.queue.put_nowait(item + (self._new_metadata,))
+        except queue.Full:
+            self.dropped += 1
+            return False
+        self._new_metadata = None
+        return True
+
+    def stop(self):
+        """Flush the queued frames, close the file and return the recording stats."""
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+        if self.dropped or self.late:
+            print(f"Recorder: {self.dropped} frames dropped, {self.late} written late "
+                  f"(max latency {self.max_latency:0.2f} s)")
+        return self.stats()
+
+    def stats(self):
+        return {'path': self.path, 'pushed': self.pushed, 'written': self.written, 'dropped': self.dropped,
+                'late': self.late, 'max_latency': self.max_latency, 'queued': self.queue.qsize()}
+
+    def finalize(self, filename):
+        """Move the finished recording to its final name, without another copy in memory."""
+        assert self.thread is None, "Stop the recorder before finalizing it"
+        shutil.move(self.path, filename)
+        self.path = filename
+        return filename
+
+    def discard(self):
+        if self.thread is None and os.path.exists(self.path):
+            os.remove(self.path)
+
+    def _run(self):
+        import tifffile  # Imported on the writer thread, only once something gets recorded
+        scratch = None
+        metadata = None
+        new_series = False
+        with tifffile.TiffWriter(self.path, bigtiff=True) as tif:
+            while True:
+                item = self.queue.get()
+                if item is None:
+                    break
+                pushed_at, frame, ring, seq, new_metadata = item
+                if new_metadata is not None:  # Kept for the next frame written if this one is dropped
+                    metadata, new_series = new_metadata, True
+                if ring is not None:
+                    if scratch is None or scratch.shape != ring.shape or scratch.dtype != ring.dtype:
+                        scratch = np.empty(ring.shape, dtype=ring.dtype)
+                    if not ring.copy_frame(seq, scratch):  # Ring wrapped around before we got to it
+                        self.dropped += 1
+                        continue
+                    frame = scratch
+                try:
+                    # A non-contiguous write ends the previous series, the next frames append to this one
+                    tif.write(frame, contiguous=not new_series, photometric='minisblack', metadata=metadata)
+                except Exception as e:  # Keep draining the queue so the acquisition side never blocks
+                    self.error = e
+                    self.dropped += 1
+                    continue
+                new_series = False
+                self.written += 1
+                latency = time.perf_counter() - pushed_at
+                self.max_latency = max(self.max_latency, latency)
+                if latency > self.late_after:
+                    self.late += 1
@@ -0,0 +1,251 @@
+"""Live frames in shared memory, for analysis running in other processes.
+
+FramePublisher copies every frame into a ring of slots in a multiprocessing.shared_memory block. Any number of local
+FrameSubscribers can attach by name and read the frames zero-copy as numpy views, without taking the acquisition
+process' GIL. A subscriber that falls behind sees the sequence numbers jump and counts the frames it missed.
+
+Layout of the block: a header (HEADER) with the ring geometry, the latest sequence number and the scan parameters as
+JSON, then one SLOT_HEADER per slot (sequence number, timestamp, shape, dtype), then the slot data. Slots are written
+seqlock style: the slot's seq is set to -1, the data copied, then seq set, so a reader that checks the seq before and
+after copying knows the copy is intact. A subscriber only needs:
+
+    with FrameSubscriber('joe_frames') as sub:
+        while True:
+            seq, frame, timestamp = sub.next()
+            ...  # frame is a read-only view, copy it (sub.copy) if it's kept beyond the next few frames
+"""
+import json
+import time
+from multiprocessing import shared_memory
+
+import numpy as np
+
+MAGIC = b'JOEFRAME'
+LAYOUT_VERSION = 1
+MAX_PARAMS = 16384  # bytes of JSON scan parameters
+MAX_NDIM = 4
+
+HEADER = np.dtype([('magic', 'S8'), ('version', '<i8'), ('capacity', '<i8'), ('slot_bytes', '<i8'),
+                   ('latest_seq', '<i8'), ('closed', '<i8'),
+                   ('params_version', '<i8'), ('params_len', '<i8'), ('params', f'S{MAX_PARAMS}')])
+SLOT_HEADER = np.dtype([('seq', '<i8'), ('timestamp', '<f8'), ('params_version', '<i8'), ('ndim', '<i8'),
+                        ('shape', '<i8', (MAX_NDIM,)), ('dtype', 'S8')])
+
+
+def _views(buf, capacity, slot_bytes):
+    header = np.ndarray((), dtype=HEADER, buffer=buf)
+    slots = np.ndarray((capacity,), dtype=SLOT_HEADER, buffer=buf, offset=HEADER.itemsize)
+    data_offset = HEADER.itemsize + capacity * SLOT_HEADER.itemsize
+    data = np.ndarray((capacity, slot_bytes), dtype=np.uint8, buffer=buf, offset=data_offset)
+    return header, slots, data
+
+
+class FramePublisher:
+    """Owner of the shared memory ring, call publish(frame) for every frame.
+
+    Frames up to slot_bytes fit, larger ones (e.g. after the pixel count was raised) are skipped and counted in
+    too_large. close() unlinks the block, subscribers still attached keep their mapping but see closed.
+    """
+
+    def __init__(self, name=None, capacity=16, slot_bytes=2 ** 22):
+        self.capacity = capacity
+        self.slot_bytes = slot_bytes
+        size = HEADER.itemsize + capacity * (SLOT_HEADER.itemsize + slot_bytes)
+        self.shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+        self.name = self.shm.name
+        self.header, self.slots, self.data = _views(self.shm.buf, capacity, slot_bytes)
+        self.header['magic'] = MAGIC
+        self.header['version'] = LAYOUT_VERSION
+        self.header['capacity'] = capacity
+        self.header['slot_bytes'] = slot_bytes
+        self.header['latest_seq'] = -1
+        self.header['params_version'] = 0
+        self.slots['seq'] = -1
+
+        self.next_seq = 0
+        self.too_large = 0
+
+    def set_params(self, params):
+        """Publish the scan parameters (a JSON-able dict, or its JSON already encoded as bytes) that go with the
+        following frames"""
+        text = params if isinstance(params, bytes) else json.dumps(params).encode()
+        assert len(text) <= MAX_PARAMS, f"Scan parameters too long to share ({len(text)} bytes)"
+        version = int(self.header['params_version'])
+        self.header['params_version'] = version + 1  # Odd while writing
+        self.header['params_len'] = len(text)
+        self.header['params'] = text
+        self.header['params_version'] = version + 2
+
+    def publish(self, frame, timestamp=None):
+        """Copy frame into the next slot, returns its sequence number (or None if it doesn't fit)"""
+        frame = np.asarray(frame)
+        if frame.nbytes > self.slot_bytes or frame.ndim > MAX_NDIM:
+            self.too_large += 1
+            return None
+        seq = self.next_seq
+        i = seq % self.capacity
+        slot = self.slots[i]
+        slot['seq'] = -1
+        self.data[i, :frame.nbytes].view(frame.dtype).reshape(frame.shape)[...] = frame
+        slot['timestamp'] = time.time() if timestamp is None else timestamp
+        slot['params_version'] = self.header['params_version']
+        slot['ndim'] = frame.ndim
+        slot['shape'][:frame.ndim] = frame.shape
+        slot['dtype'] = frame.dtype.str.encode()
+        slot['seq'] = seq
+        self.header['latest_seq'] = seq
+        self.next_seq += 1
+        return seq
+
+    def close(self):
+        if self.shm is None:
+            return
+        self.header['closed'] = 1
+        del self.header, self.slots, self.data  # Views have to go before the buffer can be released
+        self.shm.close()
+        self.shm.unlink()
+        self.shm = None
+
+
+class FrameSubscriber:
+    """Read-only client of a FramePublisher, attached by name.
+
+    next() waits for the next frame after the last one returned and counts the frames skipped over in missed (the
+    publisher overwrote them before they were read). Frame views point straight into shared memory and are only
+    valid until the publisher wraps around, use copy() to get a frame that is guaranteed intact.
+    """
+
+    def __init__(self, name, poll_interval=0.001):
+        self.shm = self._attach(name)
+        self.name = name
+        self.poll_interval = poll_interval
+        header = np.ndarray((), dtype=HEADER, buffer=self.shm.buf)
+        assert header['magic'] == MAGIC and header['version'] == LAYOUT_VERSION, f"{name} is not a frame ring"
+        self.capacity = int(header['capacity'])
+        self.slot_bytes = int(header['slot_bytes'])
+        self.header, self.slots, self.data = _views(self.shm.buf, self.capacity, self.slot_bytes)
+        self.last_seq = -1
+        self.received = 0
+        self.missed = 0
+        self._params = None
+        self._params_version = -1
+
+    @staticmethod
+    def _attach(name):
+        try:
+            return shared_memory.SharedMemory(name=name, track=False)  # python 3.13+
+        except TypeError:
+            shm = shared_memory.SharedMemory(name=name)
+            # Before 3.13 attaching registers the block with this process' resource tracker, which would unlink it
+            # (from under the publisher) when the subscriber exits
+            from multiprocessing import resource_tracker
+            resource_tracker.unregister(shm._name, 'shared_memory')
+            return shm
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    @property
+    def closed(self):
+        return bool(self.header['closed'])
+
+    @property
+    def latest_seq(self):
+        return int(self.header['latest_seq'])
+
+    @property
+    def params(self):
+        """The publisher's current scan parameters, re-parsed only when they changed"""
+        while True:
+            version = int(self.header['params_version'])
+            if version == self._params_version:
+                return self._params
+            if version % 2 == 0:
+                text = bytes(self.header['params'])[:int(self.header['params_len'])]
+                if int(self.header['params_version']) == version:
+                    self._params = json.loads(text) if text else None
+                    self._params_version = version
+                    return self._params
+            time.sleep(self.poll_interval)
+
+    def valid(self, seq):
+        return seq >= 0 and int(self.slots[seq % self.capacity]['seq']) == seq
+
+    def get(self, seq):
+        """(read-only frame view, timestamp) of frame seq, or None if it was overwritten or not published yet"""
+        i = seq % self.capacity
+        slot = self.slots[i]
+        if int(slot['seq']) != seq:
+            return None
+        ndim = int(slot['ndim'])
+        shape = tuple(int(n) for n in slot['shape'][:ndim])
+        dtype = np.dtype(bytes(slot['dtype']).decode())
+        frame = self.data[i, :dtype.itemsize * int(np.prod(shape))].view(dtype).reshape(shape)
+        frame.flags.writeable = False
+        timestamp = float(slot['timestamp'])
+        if int(slot['seq']) != seq:
+            return None
+        return frame, timestamp
+
+    def latest(self):
+        """(seq, frame view, timestamp) of the newest frame, or (-1, None, None) before the first one"""
+        while True:
+            seq = self.latest_seq
+            if seq < 0:
+                return -1, None, None
+            item = self.get(seq)
+            if item is not None:
+                return (seq,) + item
+
+    def next(self, timeout=None):
+        """Wait for the frame after the last one returned (or the newest, if that was overwritten).
+
+        Returns (seq, frame view, timestamp), or None on timeout or once the publisher closed.
+        """
+        deadline = None if timeout is None else time.perf_counter() + timeout
+        while True:
+            latest = self.latest_seq
+            if latest > self.last_seq:
+                seq = self.last_seq + 1
+                oldest = latest - self.capacity + 1
+                if seq < oldest:  # Overwritten before we got to them
+                    seq = oldest
+                item = self.get(seq)
+                if item is None:  # Overwritten just now, go again from the newest
+                    seq = latest
+                    item = self.get(seq)
+                if item is not None:
+                    if self.last_seq >= 0:
+                        self.missed += seq - self.last_seq - 1
+                    self.last_seq = seq
+                    self.received += 1
+                    return (seq,) + item
+            elif self.closed:
+                return None
+            if deadline is not None and time.perf_counter() > deadline:
+                return None
+            time.sleep(self.poll_interval)
+
+    def copy(self, seq, out=None):
+        """Copy of frame seq, or None if it was overwritten before or during the copy"""
+        item = self.get(seq)
+        if item is None:
+            return None
+        frame = item[0]
+        if out is None:
+            out = np.empty_like(frame)
+        np.copyto(out, frame)
+        return out if self.valid(seq) else None
+
+    def close(self):
+        if self.shm is None:
+            return
+        del self.header, self.slots, self.data
+        try:
+            self.shm.close()
+        except BufferError:  # Frame views still held by the caller, the mapping goes when they do
+            pass
+        self.shm = None
@@ -0,0 +1,266 @@
+"""Scan patterns other than the default full frame raster.
+
+A pattern is a small parameter object. compile() turns it into a CompiledScan: the AO waveform of one frame, kept
+within the AO limits and the galvos' slew rate, plus where each frame pixel's samples are in the AI data. WaveformGen
+caches the compiled scan next to its waveform, so a pattern is only compiled once per parameter set.
+
+Frames are still (channel, rows, cols): a raster or ROI gives an image, a line scan a kymograph (line repeat, position
+along the line) and a point scan a (cycle, point) time series of each dwell point.
+"""
+import math
+
+import numpy as np
+
+from waveforms import line_template, raster_waveform
+
+# V/s of the moves between positions (point scan jumps, the spiral's return) when no max_slew_rate is given, slow
+# enough for most small galvos. Without a limit they would be asked to jump in a single sample
+DEFAULT_TRANSIT_SLEW_RATE = 1000
+
+
+class CompiledScan:
+    """AO waveform of one frame and the sample-to-pixel map of the AI side.
+
+    With index None the samples are laid out like a raster, samples_per_pixel consecutive samples per pixel, row
+    after row. Otherwise index (rows, cols, k) holds the sample indices reduced into each pixel, gathered in one np.take.
+    For row_periodic scans every row spans the same number of samples with the same layout, so a frame can be
+    assembled a few rows at a time.
+    """
+
+    def __init__(self, waveform, shape, samples_per_pixel=1, index=None, row_periodic=True):
+        self.waveform = waveform
+        self.shape = tuple(shape)
+        self.samples_per_pixel = samples_per_pixel
+        self.index = index
+        self.row_periodic = row_periodic
+
+    @property
+    def n_samples(self):
+        return self.waveform.shape[1]
+
+    @property
+    def samples_per_row(self):
+        return self.n_samples // self.shape[0]
+
+    @property
+    def nbytes(self):
+        return self.waveform.nbytes + (self.index.nbytes if self.index is not None else 0)
+
+
+def max_step(max_slew_rate, sample_rate):
+    """Largest change in volts between two AO samples, None if unlimited"""
+    return None if not max_slew_rate else max_slew_rate / sample_rate
+
+
+def transit_step(max_slew_rate, sample_rate):
+    """max_step for the moves between positions, DEFAULT_TRANSIT_SLEW_RATE unless max_slew_rate is given"""
+    return max_step(max_slew_rate or DEFAULT_TRANSIT_SLEW_RATE, sample_rate)
+
+
+def slew_sigma(height, step):
+    """Smoothing sigma (samples) that brings a jump of height volts down to at most step volts per sample"""
+    # The steepest slope of a gaussian smoothed step is height / (sigma * sqrt(2 pi))
+    return abs(height) / (step * math.sqrt(2 * math.pi))
+
+
+def transit(start, end, step):
+    """Cosine shaped move between two (x, y) positions, (2, n) samples excluding start, within step volts/sample"""
+    distance = np.max(np.abs(np.subtract(end, start)))
+    # Peak speed of a cosine move is pi/2 times its mean speed
+    n = max(1, math.ceil(math.pi / 2 * distance / step)) if step else 1
+    s = (1 - np.cos(np.pi * np.arange(1, n + 1) / n)) / 2
+    return np.asarray(start, dtype=np.float64)[:, None] + np.subtract(end, start)[:, None] * s
+
+
+def _check_slew(waveform, step, what):
+    if step is None:
+        return
+    steepest = np.max(np.abs(np.diff(waveform, axis=1, append=waveform[:, :1])))
+    if steepest > step * (1 + 1e-6):
+        raise ValueError(f"{what} moves {steepest:0.4g} V per sample, more than the {step:0.4g} V the galvos can "
+                         f"follow, lower the sample rate or scan slower")
+
+
+class RasterScan:
+    """Full frame or rectangular region raster, x saw (or triangle) and y ramp centered on (x_offset, y_offset)"""
+
+    def __init__(self, x_amp, x_offset, y_amp, y_offset, pixels_x, pixels_y=None, samples_per_pixel=1, sigma=10,
+                 bidirectional=False):
+        self.x_amp = x_amp
+        self.x_offset = x_offset
+        self.y_amp = y_amp
+        self.y_offset = y_offset
+        self.pixels_x = pixels_x
+        if pixels_y is None:  # Square pixels
+            pixels_y = max(1, round(pixels_x * y_amp / x_amp))
+            if bidirectional:
+                pixels_y += pixels_y % 2
+        self.pixels_y = pixels_y
+        self.samples_per_pixel = samples_per_pixel
+        self.sigma = sigma
+        self.bidirectional = bidirectional
+
+    @property
+    def key(self):
+        return (type(self).__name__, self.x_amp, self.x_offset, self.y_amp, self.y_offset, self.pixels_x,
+                self.pixels_y, self.samples_per_pixel, self.sigma, self.bidirectional)
+
+    @property
+    def extent(self):
+        """(x0, x1, y0, y1) volts covered by the frame"""
+        return (self.x_offset - self.x_amp / 2, self.x_offset + self.x_amp / 2,
+                self.y_offset - self.y_amp / 2, self.y_offset + self.y_amp / 2)
+
+    def describe(self):
+        return dict(zip(('pattern', 'x_amp', 'x_offset', 'y_amp', 'y_offset', 'pixels_x', 'pixels_y',
+                         'samples_per_pixel', 'sigma', 'bidirectional'), self.key))
+
+    def compile(self, sample_rate, min_val=-10, max_val=10, max_slew_rate=None):
+        step = max_step(max_slew_rate, sample_rate)
+        sigma, y_sigma = self.sigma, 0
+        if step is not None:
+            if not self.bidirectional:  # Smooth the flybacks just enough for the galvos
+                sigma = max(sigma, slew_sigma(self.x_amp, step))
+            y_sigma = slew_sigma(self.y_amp, step)
+        waveform = raster_waveform(self.x_amp, self.x_offset, self.y_amp, self.y_offset, self.pixels_x, self.pixels_y,
+                                   self.samples_per_pixel, sigma=sigma, min_val=min_val, max_val=max_val,
+                                   bidirectional=self.bidirectional, y_sigma=y_sigma)
+        _check_slew(waveform, step, "The raster")
+        return CompiledScan(waveform, (self.pixels_y, self.pixels_x), self.samples_per_pixel)
+
+
+class RectROI(RasterScan):
+    """Raster of the rectangle (x0, y0)-(x1, y1) volts, pixels_x wide with square pixels"""
+
+    def __init__(self, x0, y0, x1, y1, pixels_x, samples_per_pixel=1, sigma=10, bidirectional=False):
+        super().__init__(abs(x1 - x0), (x0 + x1) / 2, abs(y1 - y0), (y0 + y1) / 2, pixels_x,
+                         samples_per_pixel=samples_per_pixel, sigma=sigma, bidirectional=bidirectional)
+
+
+class LineScan:
+    """The line from start to end (x, y volts) scanned lines times per frame, giving a (lines, pixels) kymograph"""
+
+    def __init__(self, start, end, pixels, lines=100, samples_per_pixel=1, sigma=10):
+        self.start = tuple(start)
+        self.end = tuple(end)
+        self.pixels = pixels
+        self.lines = lines
+        self.samples_per_pixel = samples_per_pixel
+        self.sigma = sigma
+
+    @property
+    def key(self):
+        return (type(self).__name__, self.start, self.end, self.pixels, self.lines, self.samples_per_pixel, self.sigma)
+
+    def describe(self):
+        return dict(zip(('pattern', 'start', 'end', 'pixels', 'lines', 'samples_per_pixel', 'sigma'), self.key))
+
+    def compile(self, sample_rate, min_val=-10, max_val=10, max_slew_rate=None):
+        step = max_step(max_slew_rate, sample_rate)
+        delta = np.subtract(self.end, self.start)
+        sigma = self.sigma
+        if step is not None:
+            sigma = max(sigma, slew_sigma(np.max(np.abs(delta)), step))
+        samples_per_line = self.pixels * self.samples_per_pixel
+        position = line_template(samples_per_line, sigma)  # 0 to 1 over the line
+        waveform = np.empty((2, samples_per_line * self.lines), dtype=np.float64)
+        for axis in range(2):
+            waveform[axis].reshape(self.lines, -1)[:] = self.start[axis] + delta[axis] * position
+        np.clip(waveform, min_val, max_val, out=waveform)
+        _check_slew(waveform, step, "The line scan")
+        return CompiledScan(waveform, (self.lines, self.pixels), self.samples_per_pixel)
+
+
+class SpiralScan:
+    """Archimedean spiral out from (x_offset, y_offset), resampled onto a pixels x pixels image.
+
+    The spiral is traced at constant linear speed in samples_per_frame samples (minus the return to the center), each
+    image pixel takes the nearest spiral sample. Fast for round regions, with no flyback per line.
+    """
+
+    def __init__(self, radius, turns, pixels, samples_per_frame, x_offset=0, y_offset=0):
+        self.radius = radius
+        self.turns = turns
+        self.pixels = pixels
+        self.samples_per_frame = samples_per_frame
+        self.x_offset = x_offset
+        self.y_offset = y_offset
+
+    @property
+    def key(self):
+        return (type(self).__name__, self.radius, self.turns, self.pixels, self.samples_per_frame, self.x_offset,
+                self.y_offset)
+
+    def describe(self):
+        return dict(zip(('pattern', 'radius', 'turns', 'pixels', 'samples_per_frame', 'x_offset', 'y_offset'),
+                        self.key))
+
+    def compile(self, sample_rate, min_val=-10, max_val=10, max_slew_rate=None):
+        step = max_step(max_slew_rate, sample_rate)
+        center = (self.x_offset, self.y_offset)
+        edge = (self.x_offset + self.radius * math.cos(2 * math.pi * self.turns),
+                self.y_offset + self.radius * math.sin(2 * math.pi * self.turns))
+        back = transit(edge, center, transit_step(max_slew_rate, sample_rate))
+        n = self.samples_per_frame - back.shape[1]
+        assert n > 0, "Not enough samples per frame for the return to the center"
+        # r ~ sqrt(t) keeps the linear speed about constant
+        s = np.sqrt(np.arange(n) / n)
+        theta = 2 * np.pi * self.turns * s
+        spiral = np.stack((self.x_offset + self.radius * s * np.cos(theta),
+                           self.y_offset + self.radius * s * np.sin(theta)))
+        waveform = np.ascontiguousarray(np.concatenate((spiral, back), axis=1))
+        np.clip(waveform, min_val, max_val, out=waveform)
+        _check_slew(waveform, step, "The spiral")
+
+        # Nearest spiral sample (not the return) for each pixel center
+        from scipy.spatial import cKDTree
+        grid = (np.arange(self.pixels) + 0.5) / self.pixels * 2 * self.radius - self.radius
+        gx, gy = np.meshgrid(grid + self.x_offset, grid + self.y_offset)
+        _, nearest = cKDTree(spiral.T).query(np.column_stack((gx.ravel(), gy.ravel())))
+        index = nearest.reshape(self.pixels, self.pixels, 1).astype(np.intp)
+        return CompiledScan(waveform, (self.pixels, self.pixels), index=index, row_periodic=False)
+
+
+class PointScan:
+    """Random access dwell points: the galvos visit each (x, y) point in turn and sit there for dwell samples.
+
+    The first settle samples of each dwell are discarded while the galvos settle, the rest are reduced into the
+    point's value. A frame is cycles visits of all points, giving a (cycles, points) time series.
+    """
+
+    def __init__(self, points, dwell, settle=0, cycles=1):
+        self.points = tuple(tuple(p) for p in points)
+        self.dwell = dwell
+        self.settle = settle
+        self.cycles = cycles
+        assert 0 <= settle < dwell, "settle has to leave some of the dwell samples"
+
+    @property
+    def key(self):
+        return type(self).__name__, self.points, self.dwell, self.settle, self.cycles
+
+    def describe(self):
+        return dict(zip(('pattern', 'points', 'dwell', 'settle', 'cycles'), self.key))
+
+    def compile(self, sample_rate, min_val=-10, max_val=10, max_slew_rate=None):
+        step = max_step(max_slew_rate, sample_rate)
+        move_step = transit_step(max_slew_rate, sample_rate)
+        segments = []
+        index = []
+        offset = 0
+        for i, point in enumerate(self.points):
+            # From the previous point, wrapping around to the last
+            move = transit(self.points[i - 1], point, move_step)
+            hold = np.repeat(np.asarray(point, dtype=np.float64)[:, None], self.dwell, axis=1)
+            segments += [move, hold]
+            start = offset + move.shape[1] + self.settle
+            index.append(np.arange(start, offset + move.shape[1] + self.dwell))
+            offset += move.shape[1] + self.dwell
+        cycle = np.concatenate(segments, axis=1)
+        waveform = np.ascontiguousarray(np.tile(cycle, self.cycles))
+        np.clip(waveform, min_val, max_val, out=waveform)
+        _check_slew(waveform, step, "The point scan")
+
+        index = np.stack(index)  # (points, dwell - settle)
+        index = index[None] + (np.arange(self.cycles) * cycle.shape[1])[:, None, None]
+        return CompiledScan(waveform, (self.cycles, len(self.points)), index=index.astype(np.intp))
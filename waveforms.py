@@ -0,0 +1,101 @@
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+
+def line_template(samples_per_line, sigma=10, bidirectional=False):
+    """One period of the smoothed 0 to 1 saw for the fast (x) scanner.
+
+    The flyback is smoothed with wrap-around boundaries, so the template is periodic and can be tiled line after line
+    without a seam. With bidirectional=True it is a triangle instead, two lines long: a forward line followed by a
+    reversed one, with no flyback and only the turnarounds smoothed.
+    """
+    if bidirectional:
+        ramp = (np.arange(samples_per_line) + 0.5) / samples_per_line
+        xraw = np.concatenate((ramp, ramp[::-1]))
+    else:
+        xraw = ((np.arange(samples_per_line) + 1) % samples_per_line) / samples_per_line
+    if sigma:
+        from scipy.ndimage import gaussian_filter1d  # scipy takes a while to import, only load it when used
+        xraw = gaussian_filter1d(xraw, sigma=sigma, mode='wrap')
+    return xraw
+
+
+def raster_waveform(x_amp, x_offset, y_amp, y_offset, pixels_x, pixels_y, samples_per_pixel, sigma=10,
+                    min_val=-10, max_val=10, bidirectional=False, y_sigma=0):
+    """Build a full frame of AO samples, shape (2, samples_per_frame), C-contiguous float64.
+
+    For bidirectional scans pixels_y must be even, so every frame starts with a forward line. y_sigma (samples)
+    smooths the slow axis flyback at the end of the frame the same way sigma does for the fast axis.
+    """
+    samples_per_line = pixels_x * samples_per_pixel
+    out = np.empty((2, samples_per_line * pixels_y), dtype=np.float64)
+
+    # X fast scanner, one compiled line (pair of lines if bidirectional) tiled over the frame through a view of row 0
+    xline = (line_template(samples_per_line, sigma, bidirectional) - 0.5) * x_amp + x_offset
+    if bidirectional:
+        assert pixels_y % 2 == 0, "Bidirectional scans need an even number of lines"
+    out[0].reshape(-1, len(xline))[:] = xline
+
+    # Y slow scanner
+    out[1] = np.linspace(y_offset - y_amp / 2, y_offset + y_amp / 2, out.shape[1])
+    if y_sigma:
+        from scipy.ndimage import gaussian_filter1d
+        gaussian_filter1d(out[1], sigma=y_sigma, mode='wrap', output=out[1])
+
+    np.clip(out, min_val, max_val, out=out)
+    return out
+
+
+def nbytes(value):
+    """Memory held by a cached value: an array, something with an nbytes (CompiledScan) or a tuple of those"""
+    if isinstance(value, (tuple, list)):
+        return sum(nbytes(v) for v in value)
+    return getattr(value, 'nbytes', 0)
+
+
+class WaveformCache:
+    """Small bounded LRU cache of compiled frame waveforms, keyed by the scan parameters.
+
+    Bounded by the total bytes of the cached buffers, frame waveforms range from kilobytes to hundreds of megabytes.
+    The newest buffer is always kept, even on its own over max_bytes.
+
+    The returned buffers are shared between callers and handed straight to the AO writer, so they must not be
+    modified in place. Safe to use from several threads (e.g. WaveformGen.prepare in the background), a buffer
+    requested by two threads at once may just be built twice.
+    """
+
+    def __init__(self, max_bytes=2 ** 28):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self._cache = OrderedDict()  # key: (buffer, bytes)
+        self._lock = threading.Lock()
+
+    def get(self, key, build):
+        """Return the cached buffer for key, calling build() to compile it on a miss."""
+        with self._lock:
+            try:
+                self._cache.move_to_end(key)
+                return self._cache[key][0]
+            except KeyError:
+                pass
+        buf = build()  # Outside the lock, builds can nest (chunks of a waveform)
+        size = nbytes(buf)
+        with self._lock:
+            old = self._cache.pop(key, None)
+            if old is not None:  # Built twice
+                self.nbytes -= old[1]
+            self._cache[key] = (buf, size)
+            self.nbytes += size
+            while self.nbytes > self.max_bytes and len(self._cache) > 1:
+                self.nbytes -= self._cache.popitem(last=False)[1][1]
+        return buf
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+            self.nbytes = 0
+
+    def __len__(self):
+        return len(self._cache)
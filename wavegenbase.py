@@ -1,17 +1,32 @@
-import nidaqmx
+import json
+import math
+import threading
+import time
+
 import numpy as np
-from nidaqmx import stream_readers, stream_writers
-from scipy.ndimage import gaussian_filter1d
 
-from matplotlib import pyplot as plt
+from assembly import (GatherBinner, LineCorrector, PixelBinner, ResamplingBinner, estimate_line_phase,
+                      linearization_map, scale_counts)
+from daqbackend import open_backend
+from framering import FrameRing
+from metrics import HotPathMetrics, MetricsLog
+from recorder import FrameRecorder
+from sharedframes import FramePublisher
+from trajectories import RasterScan
+from waveforms import WaveformCache
+
+# Parameters that can be swapped in at a frame boundary while scanning, as long as the frame geometry stays the same
+LIVE_PARAMS = ('x_amp', 'x_offset', 'y_amp', 'y_offset', 'smoothing_sigma')
 
 
 class WaveformGen:
-    def __init__(self, devname='Dev2', sample_rate=20000, loopback_debug=False):
-        self.devname = devname
-        device = nidaqmx.system.Device(devname)
-        print(f"Connecting to {devname}: {device.product_type}")
-        assert device.ao_min_rate <= sample_rate <= device.ao_max_rate
+    def __init__(self, devname='Dev2', sample_rate=20000, loopback_debug=False, backend=None):
+        # devname='sim' runs against the software DAQ simulator, 'auto' takes the first NI device, or pass an already
+        # configured backend
+        self.backend = backend if backend is not None else open_backend(devname)
+        self.devname = getattr(self.backend, 'devname', devname)  # 'auto' resolved
+        print(f"Connecting to {self.devname}: {self.backend.product_type}")
+        assert self.backend.ao_min_rate <= sample_rate <= self.backend.ao_max_rate
         self.sample_rate = sample_rate
 
         # Set initial params
@@ -24,36 +39,90 @@ class WaveformGen:
         self.samples_per_pixel = 1
         self.pixels_x = 100
         # self.aspect_ratio = 1  # square pixels for now
+        self.smoothing_sigma = 10  # samples, gaussian smoothing of the fast axis flyback
+        self.binning = 'mean'  # how the samples of each pixel are reduced, 'mean', 'sum', 'max' or 'count'
+        self.count_threshold = 0.1  # volts, samples above this are counted with binning='count'
+        # Acquire raw int16 ADC counts instead of float64 volts, a quarter of the read bandwidth and half the frame memory
+        # (frames are int32 when summing several samples per pixel, see frame_dtype).
+        # Frames and recordings hold counts, scale_frame converts them with the coefficients captured in init_ai
+        self.raw = False
+        self.ai_scaling_coeffs = None
+        self.bidirectional = False  # triangle fast axis, every other line is acquired in reverse
+        self.line_phase = 0.0  # samples, shift of the reverse lines to correct galvo lag, see set_line_phase
+        # Resample each line at evenly spaced galvo positions instead of binning consecutive samples, which corrects the
+        # stretched edges of the smoothed saw and leaves out the flyback. The positions come from the commanded
+        # waveform, or from a loopback measurement once calibrate_linearization has been run
+        self.linearize = False
+        self.scan_calibration = None  # measured fast axis position of each sample of a line
+        self._calibration_version = 0
+        # A trajectories scan pattern (ROI, line scan, spiral, points) used instead of the raster set by the params above
+        self.trajectory = None
+        # V/s the galvos can follow, waveforms are compiled within it if set. Without it the moves between positions
+        # of point and spiral scans still stay within trajectories.DEFAULT_TRANSIT_SLEW_RATE
+        self.max_slew_rate = None
 
         # refresh_rate_hz = self.fps  # Hz, approx how often the NI board is serviced
-        self.buffer_oversize = 6  # fold, how much bigger is the buffer than one 'refresh' worth
+        # The callbacks fire every lines_per_chunk lines, or about every chunk_interval seconds, or once per frame if
+        # both are None. Chunks are whole lines and divide the frame evenly, see chunk_lines
+        self.lines_per_chunk = None
+        self.chunk_interval = None
+        self.buffer_oversize = 6  # fold, how much bigger is the buffer than one 'refresh' (callback chunk) worth
+        self.ring_capacity = 32  # frames held in the preallocated frame ring for consumers (display, recorder, ...)
 
         # AI params
         self.ai_channels = ['/ai0']  # '/ai1'
         self.ai_args = {'min_val': -10,
                         'max_val': 10,
-                        'terminal_config': nidaqmx.constants.TerminalConfiguration.RSE}
+                        'terminal_config': 'RSE'}
         if loopback_debug:
             # loopback AO test
             self.ai_channels = ['/_ao0_vs_aognd', '/_ao1_vs_aognd']
             self.ai_args = {'min_val': -5,
                             'max_val': 5,
-                            'terminal_config': nidaqmx.constants.TerminalConfiguration.BAL_DIFF}
-        self.reader = None
+                            'terminal_config': 'BAL_DIFF'}
         self.ai_task = None
+        self.ring = None
+        self.binner = None
+        self.line_corrector = None
 
         # AO params
         self.ao_channels = ['/ao0', '/ao1']
         self.ao_args = {'min_val': -3,
                         'max_val': 3}
-        self.writer = None
         self.ao_task = None
 
         self.ao_counter = 0
         self.ai_counter = 0
-
-        self.frames = []
-        self.reading_image_callback = None
+        self.start_seq = 0  # ring sequence number of the first frame of the current (or last) run
+        self.running = False
+        # pixels_y while scanning, kept when the amplitudes change live (pixels go non-square until the next restart)
+        self._running_pixels_y = None
+        self._configured = None  # geometry_key the committed tasks were configured for
+        self._task_key = None  # task_key the committed tasks were created with
+
+        # Parameter changes staged while scanning, applied by the AO callback at the next frame boundary
+        self._staged = {}
+        self._staged_ready = (None, None, None)  # (waveform chunks, binner, scan params JSON) built for _staged
+        self._staged_lock = threading.Lock()
+        self._ao_chunks = None  # waveform_chunks() being written
+        self.param_changes = []  # (frame index, params) of the changes applied during the current (or last) run
+
+        # Callback timing, buffer headroom and drift, reset on every start, see metrics.snapshot()
+        self.metrics = HotPathMetrics()
+        self.metrics_enabled = True
+        self.metrics_log = None
+
+        # Compiled frame waveforms, recomputed only when the scan parameters change
+        self.waveform_cache = WaveformCache(max_bytes=2 ** 28)
+
+        self.recorder = None  # FrameRecorder streaming frames to disk, see start_recording
+        self._recording_metadata = None  # metadata given to start_recording
+        self._recorded_changes = 0  # param_changes already saved in the recorder's metadata
+        self.publisher = None  # FramePublisher sharing frames with other processes, see start_publishing
+        self.pipeline = None  # processing.ProcessingPipeline fed every frame, it runs (and is started) on its own
+        self.reading_image_callback = None  # Called with (seq, read-only frame view) from the acquisition thread
+        # Called with (seq, read-only view of the frame being filled, lines filled so far) after every chunk
+        self.reading_lines_callback = None
         # Could use a clock to drive both tasks, but not sure if helps at all?
         # sample_clk_task = nidaqmx.Task()
         # self.sample_clk_task = sample_clk_task
@@ -68,66 +137,287 @@ class WaveformGen:
 
     @property
     def fps(self):
+        if self.trajectory is not None:
+            return self.sample_rate / self.compiled_scan().n_samples
         return self.sample_rate / (self.pixels_x * self.pixels_y * self.samples_per_pixel)
 
     @property
     def pixels_y(self):
-        return round(self.pixels_x * self.y_amp / self.x_amp)
+        if self._running_pixels_y is not None:
+            return self._running_pixels_y
+        return self._pixels_y(self.pixels_x, self.x_amp, self.y_amp, self.bidirectional)
+
+    @staticmethod
+    def _pixels_y(pixels_x, x_amp, y_amp, bidirectional):
+        pixels_y = round(pixels_x * y_amp / x_amp)
+        if bidirectional:  # Whole forward/reverse line pairs per frame
+            pixels_y += pixels_y % 2
+        return pixels_y
+
+    @property
+    def samples_per_line(self):
+        if self.trajectory is not None:
+            return self.compiled_scan().samples_per_row
+        return self.pixels_x * self.samples_per_pixel
 
     @property
     def samples_per_refresh(self):
+        if self.trajectory is not None:
+            return self.compiled_scan().n_samples
         return round(self.sample_rate / self.fps)
 
+    @property
+    def frame_rows(self):
+        if self.trajectory is not None:
+            return self.compiled_scan().shape[0]
+        return self.pixels_y
+
+    @property
+    def requested_chunk_lines(self):
+        """Lines per callback asked for with lines_per_chunk or chunk_interval, None for whole frames"""
+        return self._requested_chunk_lines(self.samples_per_line)
+
+    def _requested_chunk_lines(self, samples_per_line):
+        if self.lines_per_chunk:
+            return self.lines_per_chunk
+        if self.chunk_interval:
+            return max(1, round(self.chunk_interval * self.sample_rate / samples_per_line))
+        return None
+
+    @property
+    def chunk_lines(self):
+        """Lines per callback, the divisor of frame_rows nearest (by ratio) to the requested chunk size.
+
+        Chunks have to divide the frame evenly, so with an awkward line count (e.g. a prime) this can be far from the
+        request, in either direction, configure_ai warns when it is.
+        """
+        if self.trajectory is not None:
+            scan = self.compiled_scan()
+            return self._chunk_lines(scan.shape[0], scan.samples_per_row, row_periodic=scan.row_periodic)
+        return self._chunk_lines(self.pixels_y, self.samples_per_line, line_pairs=self.bidirectional)
+
+    def _chunk_lines(self, rows, samples_per_line, row_periodic=True, line_pairs=False):
+        if not row_periodic:
+            return rows  # Can only be assembled as a whole
+        requested = self._requested_chunk_lines(samples_per_line)
+        if requested is None:
+            return rows
+        step = 2 if line_pairs else 1  # keep forward/reverse line pairs together
+        divisors = [k for k in range(step, rows + 1, step) if rows % k == 0]
+        # Ties go to the bigger chunk, fewer callbacks
+        return min(divisors, key=lambda k: (abs(math.log(k / requested)), -k))
+
+    @property
+    def samples_per_chunk(self):
+        return self.samples_per_refresh // self.chunks_per_frame
+
+    @property
+    def chunks_per_frame(self):
+        return self.frame_rows // self.chunk_lines
+
+    @property
+    def pixel_samples(self):
+        """AI samples reduced into each pixel, the compiled scan's for trajectories"""
+        if self.trajectory is not None:
+            scan = self.compiled_scan()
+            return scan.index.shape[2] if scan.index is not None else scan.samples_per_pixel
+        return self.samples_per_pixel
+
+    @property
+    def frame_shape(self):
+        if self.trajectory is not None:
+            return (len(self.ai_channels),) + self.compiled_scan().shape
+        return len(self.ai_channels), self.pixels_y, self.pixels_x
+
+    @property
+    def frame_dtype(self):
+        if not self.raw:
+            return np.dtype(np.float32)
+        # Summed counts can overflow int16
+        if self.binning == 'sum' and (self.samples_per_pixel > 1 or self.trajectory is not None):
+            return np.dtype(np.int32)
+        return np.dtype(np.int16)
+
+    @property
+    def scan_params(self):
+        return {'sample_rate': self.sample_rate, 'x_amp': self.x_amp, 'x_offset': self.x_offset,
+                'y_amp': self.y_amp, 'y_offset': self.y_offset, 'pixels_x': self.pixels_x, 'pixels_y': self.pixels_y,
+                'samples_per_pixel': self.samples_per_pixel, 'binning': self.binning,
+                'bidirectional': self.bidirectional, 'line_phase': self.line_phase, 'ai_channels': list(self.ai_channels),
+                'trajectory': self.trajectory.describe() if self.trajectory is not None else None}
+
     @property
     def timebase(self):
         return np.arange(self.samples_per_refresh) / self.sample_rate
 
+    @property
+    def geometry_key(self):
+        # Anything that changes the buffer sizes or how samples are assembled into frames
+        return (self.samples_per_refresh, self.pixels_x, self.pixels_y, self.samples_per_pixel, tuple(self.ai_channels),
+                self.binning, self.count_threshold, self.bidirectional, self.chunk_lines, self.raw,
+                self.trajectory.key if self.trajectory is not None else None, self.linearize, self._calibration_version)
+
+    @property
+    def task_key(self):
+        # Anything the tasks are created with, which a buffer resize can't change
+        return (tuple(self.ai_channels), tuple(self.ao_channels), self.sample_rate,
+                tuple(sorted(self.ai_args.items())), tuple(sorted(self.ao_args.items())))
+
     def init_ai(self):
-        self.ai_task = nidaqmx.Task()
-        for ch in self.ai_channels:
-            self.ai_task.ai_channels.add_ai_voltage_chan(self.devname + ch, **self.ai_args)
-        self.read_buffer = np.zeros((len(self.ai_channels), self.samples_per_refresh), dtype=np.float64)
-        self.ai_task.timing.cfg_samp_clk_timing(rate=self.sample_rate, sample_mode=nidaqmx.constants.AcquisitionType.CONTINUOUS)
         # Configure ai to start only once ao is triggered for simultaneous generation and acquisition:
-        self.ai_task.triggers.start_trigger.cfg_dig_edge_start_trig("ao/StartTrigger", trigger_edge=nidaqmx.constants.Edge.RISING)
-
-        self.ai_task.in_stream.input_buf_size = self.samples_per_refresh * len(self.ai_channels) * self.buffer_oversize
-        self.reader = stream_readers.AnalogMultiChannelReader(self.ai_task.in_stream)
-        self.ai_task.register_every_n_samples_acquired_into_buffer_event(self.samples_per_refresh, self.reading_task_callback)
+        self.ai_task = self.backend.create_ai_task(
+            self.ai_channels, self.sample_rate,
+            buffer_size=self.samples_per_chunk * len(self.ai_channels) * self.buffer_oversize,
+            start_trigger="ao/StartTrigger", **self.ai_args)
+        # Read once, the calibration doesn't change while the task exists
+        self.ai_scaling_coeffs = self.ai_task.scaling_coeffs()
+        self.configure_ai()
+
+    def configure_ai(self):
+        """(Re)size the AI buffers and frame assembly for the current geometry, the task itself is reused"""
+        n_channels = len(self.ai_channels)
+        max_rate = self.backend.ai_max_rate(n_channels)
+        assert self.sample_rate * n_channels <= max_rate, \
+            f"{n_channels} AI channels at {self.sample_rate} Hz exceed the board's {max_rate} Hz aggregate AI rate"
+        # Sized for one chunk, so the per-callback memory doesn't grow with the frame size
+        self.read_buffer = np.zeros((n_channels, self.samples_per_chunk), dtype=np.int16 if self.raw else np.float64)
+        if self.ring is None or self.ring.shape != self.frame_shape or self.ring.dtype != self.frame_dtype:
+            self.ring = FrameRing(self.ring_capacity, self.frame_shape, dtype=self.frame_dtype)
+        threshold = self.count_threshold
+        if self.raw:  # Volts to counts, the first channel's (linear part of the) calibration
+            c0, c1 = self.ai_scaling_coeffs[0][:2]
+            threshold = (threshold - c0) / c1
+        # Looked up once here rather than on every callback
+        self._chunk_rows, self._n_chunks = self.chunk_lines, self.chunks_per_frame
+        requested = self.requested_chunk_lines
+        if requested is not None and not 0.5 <= self._chunk_rows / requested <= 2:
+            print(f"Asked for {requested} lines per callback, but the nearest even split of the {self.frame_rows} lines "
+                  f"of a frame is {self._chunk_rows} lines, one callback every "
+                  f"{self.samples_per_chunk / self.sample_rate * 1e3:0.1f} ms")
+        self._threshold = threshold
+        self.binner = self._build_binner()
+        self.set_line_phase(self.line_phase)
+        self.ai_task.set_buffer_size(self.samples_per_chunk * n_channels * self.buffer_oversize)
+        self.ai_task.register_every_n_samples(self.samples_per_chunk, self.reading_task_callback)
+
+    def _build_binner(self, staged=None):
+        # staged: LIVE_PARAMS about to be swapped in, see update_params
+        scan = self.compiled_scan() if self.trajectory is not None else None
+        if scan is not None and scan.index is not None:
+            # Row periodic, so the first chunk's index is the same for every chunk relative to its first sample
+            return GatherBinner(scan.index[:self._chunk_rows], mode=self.binning, threshold=self._threshold,
+                                dtype=self.read_buffer.dtype)
+        pixels_x, samples_per_pixel = self.pixels_x, self.samples_per_pixel
+        if scan is not None:
+            pixels_x, samples_per_pixel = scan.shape[1], scan.samples_per_pixel
+        if self.linearize:
+            idx0, weights = self.linearization_map(staged)
+            return ResamplingBinner(idx0, weights, mode=self.binning, threshold=self._threshold,
+                                    dtype=self.read_buffer.dtype)
+        return PixelBinner(self._chunk_rows, pixels_x, samples_per_pixel, mode=self.binning, threshold=self._threshold)
+
+    def linearization_map(self, staged=None):
+        """idx0/weights resampling one chunk's lines at even fast axis positions, cached with the waveform"""
+        def build():
+            spl = self.samples_per_line
+            positions = self.scan_calibration
+            if positions is None or len(positions) != spl:
+                line = self.waveform_chunks(staged)[0][:, :spl]  # The first chunk starts with a whole line
+                positions = line[np.argmax(np.ptp(line, axis=1))]  # The fast axis moves the most within a line
+                smooth = 0
+            else:
+                smooth = 3  # Measured, so noisy
+            scan = self.compiled_scan() if self.trajectory is not None else None
+            pixels_x, samples_per_pixel = (scan.shape[1], scan.samples_per_pixel) if scan is not None else \
+                (self.pixels_x, self.samples_per_pixel)
+            return linearization_map(positions, self._chunk_rows, pixels_x, samples_per_pixel, smooth=smooth)
+
+        return self.waveform_cache.get(self._waveform_key(staged) + ('linearization', self._chunk_rows,
+                                                                    self._calibration_version), build)
+
+    def calibrate_linearization(self, channel=0):
+        """Use the last acquired chunk of an AO loopback channel (loopback_debug) as the fast axis position.
+
+        The lines of the chunk are averaged into the position of each sample of a line, which includes the galvo (or
+        output filter) lag that the commanded waveform doesn't. Applied right away if scanning with linearize on.
+        """
+        lines = self.read_buffer[channel].reshape(self._chunk_rows, self.samples_per_line)
+        self.scan_calibration = lines.mean(axis=0)
+        self._calibration_version += 1
+        if self.linearize and self.running:
+            self.binner = self._build_binner()  # Swapped in with one assignment like the line corrector
+        return self.scan_calibration
 
     def init_ao(self):
-        ao_task = nidaqmx.Task()
-        self.ao_task = ao_task
-        for ch in self.ao_channels:
-            ao_task.ao_channels.add_ao_voltage_chan(self.devname + ch, **self.ao_args)
-        ao_task.timing.cfg_samp_clk_timing(rate=self.sample_rate, sample_mode=nidaqmx.constants.AcquisitionType.CONTINUOUS)
-        # Set output buffer to correct size
-        ao_task.out_stream.output_buf_size = self.samples_per_refresh * len(self.ao_channels) * self.buffer_oversize
-        self.writer = stream_writers.AnalogMultiChannelWriter(ao_task.out_stream)
-        # fill buffer for first time
-        for _ in range(self.buffer_oversize):
-            self.writer.write_many_sample(self.waveform())
+        self.ao_task = self.backend.create_ao_task(
+            self.ao_channels, self.sample_rate,
+            buffer_size=self.samples_per_chunk * len(self.ao_channels) * self.buffer_oversize, **self.ao_args)
+        self.configure_ao()
 
-        self.ao_task.register_every_n_samples_transferred_from_buffer_event(self.samples_per_refresh, self.writing_task_callback)
+    def configure_ao(self):
+        # Set output buffer to correct size
+        self.ao_task.set_buffer_size(self.samples_per_chunk * len(self.ao_channels) * self.buffer_oversize)
+        self.ao_task.register_every_n_samples(self.samples_per_chunk, self.writing_task_callback)
 
     def init_tasks(self):
         self.init_ai()
         self.init_ao()
+        # Commit the tasks once, so start/stop cycles don't go through the full driver setup each time
+        self.ai_task.commit()
+        self.ao_task.commit()
+        self._configured = self.geometry_key
+        self._task_key = self.task_key
+
+    def prepare(self):
+        """Compile the waveform and allocate the frame ring for the current parameters, so the first start() has less
+        to do. Doesn't touch the DAQ and can run on a background thread, as long as it has finished before start()"""
+        self.waveform_chunks()
+        if self.ring is None or self.ring.shape != self.frame_shape or self.ring.dtype != self.frame_dtype:
+            self.ring = FrameRing(self.ring_capacity, self.frame_shape, dtype=self.frame_dtype)
 
     def start(self):
+        # Square pixels for the current amplitudes, kept until stop, see update_params
+        self._running_pixels_y = self._pixels_y(self.pixels_x, self.x_amp, self.y_amp, self.bidirectional)
+        if self._task_key != self.task_key:
+            # Channels, rate or task arguments changed, the tasks have to be created again
+            self.close()
         if self.ai_task is None or self.ao_task is None:
             self.init_tasks()
+        elif self._configured != self.geometry_key:
+            # Geometry changed since the tasks were set up, only the buffers need resizing
+            self.configure_ai()
+            self.configure_ao()
+            self._configured = self.geometry_key
+        self._ao_chunk = self._ai_chunk = 0
+        self._ao_chunks = self.waveform_chunks()
+        # fill buffer for first time
+        for _ in range(self.buffer_oversize):
+            self._write_chunk()
+        self.metrics.reset(nominal_period=self.samples_per_chunk / self.sample_rate,
+                           ai_buffer=self.samples_per_chunk * len(self.ai_channels) * self.buffer_oversize,
+                           ao_buffer=self.samples_per_chunk * len(self.ao_channels) * self.buffer_oversize)
+        if self.publisher is not None:
+            self.publisher.set_params(self.scan_params)
+        self.param_changes = []
+        self._recorded_changes = 0
+        if self.recorder is not None:
+            # Geometry, raw or anything else may have changed since recording started, a new series if it did
+            self.recorder.set_metadata(self.recorder_metadata())
+        self.start_seq = self.ring.next_seq
+        self.running = True
         self.ai_task.start()
         self.ao_task.start()
 
     def stop(self):
+        self.running = False
         if self.ai_task is not None:
             self.ai_task.stop()
         if self.ao_task is not None:
             self.ao_task.stop()
+        self.apply_staged_params()
+        self._running_pixels_y = None
         self.ai_counter = 0
         self.ao_counter = 0
-        self.frames = []
 
     def close(self):
         if self.ai_task is not None:
@@ -137,6 +427,128 @@ class WaveformGen:
             self.ao_task.close()
             self.ao_task = None
 
+    def start_metrics_log(self, path, interval=1.0, max_bytes=10_000_000):
+        """Append a metrics snapshot every interval seconds to a rolling .jsonl (or .csv) file"""
+        self.stop_metrics_log()
+        self.metrics_log = MetricsLog(self.metrics, path, interval=interval, max_bytes=max_bytes)
+        self.metrics_log.start()
+
+    def stop_metrics_log(self):
+        if self.metrics_log is not None:
+            self.metrics_log.stop()
+            self.metrics_log = None
+
+    def update_params(self, **params):
+        """Change scan parameters (any of the attributes, e.g. x_amp=1.5, pixels_x=200), also while scanning.
+
+        While scanning, amplitude/offset changes that keep the frame geometry are staged and swapped in by the AO
+        callback at the next frame boundary, so the scan carries on with the line phase intact. The AO buffer holds
+        buffer_oversize chunks (chunk_lines lines each), so they reach the galvos that many chunks after the boundary
+        they were swapped in at. The number of lines is kept while scanning, so amplitude changes make the pixels
+        non-square until the next restart (any other change, or stop/start) squares them again. Geometry changes stop
+        the committed tasks, resize the buffers and restart, without recreating the tasks.
+        """
+        with self._staged_lock:
+            current = dict({k: getattr(self, k) for k in params}, **self._staged)
+        params = {k: v for k, v in params.items() if current[k] != v}
+        if not params:
+            return
+        if not self.running:
+            for k, v in params.items():
+                setattr(self, k, v)
+            return
+
+        staged = dict(current, **params)
+        # pixels_y stays as it was at start while scanning, so zooming never changes the geometry
+        if set(params) <= set(LIVE_PARAMS):
+            # Everything the AO callback swaps in is built here, on the caller's thread, the callback only has
+            # buffer_oversize chunks of headroom and can't afford compiling a waveform
+            chunks = self.waveform_chunks(staged)
+            binner = None
+            if self.linearize and 'smoothing_sigma' in params and self.scan_calibration is None:
+                binner = self._build_binner(staged)  # The line shape changed
+            text = None
+            if self.publisher is not None:
+                scan_params = self.scan_params
+                text = json.dumps(dict(scan_params, **{k: v for k, v in staged.items() if k in scan_params})).encode()
+            with self._staged_lock:
+                self._staged.update(params)
+                self._staged_ready = (chunks, binner, text)
+            return
+
+        self.stop()
+        for k, v in params.items():
+            setattr(self, k, v)
+        self.start()
+
+    def apply_staged_params(self):
+        """Swap in the staged parameters and the buffers update_params built for them"""
+        with self._staged_lock:
+            staged, self._staged = self._staged, {}
+            (chunks, binner, text), self._staged_ready = self._staged_ready, (None, None, None)
+        for k, v in staged.items():
+            setattr(self, k, v)
+        if chunks is not None:
+            self._ao_chunks = chunks
+        if binner is not None and self.binner is not None:
+            self.binner = binner
+        if text is not None and self.publisher is not None:
+            self.publisher.set_params(text)
+        if staged and self.running:
+            # Frame index at which the change reaches the outputs, ao_counter includes the frames primed at start
+            self.param_changes.append((self.ao_counter, staged))
+
+    def start_recording(self, path, queue_size=None, max_frames=None, metadata=None):
+        """Stream every acquired frame (or the first max_frames) to a BigTIFF file at path until stop_recording is
+        called. metadata is saved along with the scan parameters"""
+        assert self.recorder is None, "Already recording, call .stop_recording first"
+        if queue_size is None:  # Leave some slack so queued frames aren't overwritten in the ring before being written
+            queue_size = max(1, self.ring_capacity - 4)
+        self._recording_metadata = dict(metadata or {})
+        self.recorder = FrameRecorder(path, metadata=self.recorder_metadata(), queue_size=queue_size,
+                                      max_frames=max_frames)
+        self.recorder.start()
+        return self.recorder
+
+    def recorder_metadata(self):
+        """What's saved with the recorded frames, the current scan parameters, the start_recording metadata and the
+        parameter changes applied while scanning so far"""
+        metadata = dict(self.scan_params, axes='TCYX', **(self._recording_metadata or {}))
+        if self.raw:
+            metadata.update(raw=True, ai_scaling_coeffs=self.ai_scaling_coeffs)
+        if self.param_changes:
+            metadata['param_changes'] = [[frame, params] for frame, params in self.param_changes]
+        return metadata
+
+    def stop_recording(self, wait=True):
+        """Flush and close the recording, returns the finished FrameRecorder (or None if not recording).
+
+        With wait=False the recorder is only detached, the caller has to call its stop(), e.g. from another thread
+        so flushing overlaps with the next acquisition.
+        """
+        recorder, self.recorder = self.recorder, None
+        if recorder is not None and wait:
+            recorder.stop()
+        return recorder
+
+    def start_publishing(self, name=None, capacity=16, max_frame_bytes=None):
+        """Share every acquired frame through a shared memory ring other processes can read with a FrameSubscriber.
+
+        Frames larger than max_frame_bytes (default 4 MB, or the current frame size if larger) are skipped, returns
+        the FramePublisher, whose name the subscribers attach to.
+        """
+        assert self.publisher is None, "Already publishing, call .stop_publishing first"
+        frame_bytes = int(np.prod(self.frame_shape)) * self.frame_dtype.itemsize
+        publisher = FramePublisher(name, capacity=capacity, slot_bytes=max_frame_bytes or max(frame_bytes, 2 ** 22))
+        publisher.set_params(self.scan_params)
+        self.publisher = publisher
+        return publisher
+
+    def stop_publishing(self):
+        publisher, self.publisher = self.publisher, None
+        if publisher is not None:
+            publisher.close()
+
     # def __del__(self):
     #     self.close()
 
@@ -145,46 +557,119 @@ class WaveformGen:
         assert len(voltages) == len(self.ao_channels)
 
         assert self.ao_task is None, "Can't set voltages when task is active, call .stop first"
-
-        # make temp channel and writer
-        with nidaqmx.Task() as temptask:
-            for ch in self.ao_channels:
-                temptask.ao_channels.add_ao_voltage_chan(self.devname + ch, **self.ao_args)
-
-            temptask.write(np.asarray(voltages, dtype=np.float64), timeout=2.0, auto_start=True)
-            temptask.wait_until_done()
-            temptask.stop()
+        self.backend.set_voltages(self.ao_channels, voltages, **self.ao_args)
 
     def zero_output(self):
         self.set_voltages([0, ] * len(self.ao_channels))
 
     def park(self, parkXvolts=8, parkYvolts=8, amp_volts=0):
-        self.set_voltages((parkXvolts, parkYvolts, amp_volts))
+        self.set_voltages((parkXvolts, parkYvolts, amp_volts)[:len(self.ao_channels)])
 
-    def waveform(self):
-        # Use a starting phase offset to ensure waveform generation is smooth, even if other waveform parameters change
+    @property
+    def waveform_key(self):
+        return self._waveform_key()
+
+    def _waveform_key(self, staged=None):
+        return self._scan_snapshot(staged, self.trajectory)[2]
+
+    def _scan_snapshot(self, staged, trajectory):
+        """(scan pattern, AO limits, waveform key): trajectory, or the raster of the current parameters with staged
+        overriding LIVE_PARAMS. The parameters are read once, so a waveform compiled from the snapshot matches its key
+        even if they change meanwhile, e.g. while prepare() runs on its own thread"""
+        limits = (self.sample_rate, self.ao_args['min_val'], self.ao_args['max_val'], self.max_slew_rate)
+        if trajectory is not None:
+            return trajectory, limits, trajectory.key + limits
+        # laser amplitude control, turn off laser near flyback/edges
+        # ampdata = ((unscaled_wave < .95) & (unscaled_wave > .05)).astype(int)
+        p = dict((k, getattr(self, k)) for k in LIVE_PARAMS)
+        p.update(staged or {})
+        # pixels_y is kept while scanning, staged amplitudes don't change it
+        raster = RasterScan(p['x_amp'], p['x_offset'], p['y_amp'], p['y_offset'], self.pixels_x, self.pixels_y,
+                            self.samples_per_pixel, sigma=p['smoothing_sigma'], bidirectional=self.bidirectional)
+        return raster, limits, raster.key + limits
 
-        # X fast scanner
-        # creates 0 to 1 saw wave
-        xraw = ((np.arange(self.samples_per_refresh) + 1) % (self.samples_per_pixel * self.pixels_x)) / (self.samples_per_pixel * self.pixels_x)
-        xraw = np.pad(np.cumsum(gaussian_filter1d(np.diff(xraw), sigma=10)), (1, 0))
-        xscaled = (xraw - 0.5) * self.x_amp + self.x_offset
+    def waveform(self):
+        """Returns the AO samples for one frame, shape (n_ao_channels, samples_per_refresh).
 
-        # Y slow scanner
-        yscaled = np.linspace(self.y_offset - self.y_amp / 2, self.y_offset + self.y_amp / 2, self.samples_per_refresh)
+        Only the chunk-major waveform_chunks() buffer the AO writer uses is cached, this is assembled from it, a copy
+        unless the frame is a single chunk. Don't modify it in place.
+        """
+        chunks = self.waveform_chunks()
+        return chunks.transpose(1, 0, 2).reshape(chunks.shape[1], -1)
 
-        # laser amplitude control, turn off laser near flyback/edges
-        # ampdata = ((unscaled_wave < .95) & (unscaled_wave > .05)).astype(int)
+    def compiled_scan(self, snapshot=None):
+        """The trajectory (or that of a _scan_snapshot) compiled to its AO waveform and sample-to-pixel map, cached"""
+        scan, limits, key = snapshot or self._scan_snapshot(None, self.trajectory)
+        return self.waveform_cache.get(key, lambda: scan.compile(*limits))
 
-        # plt.figure()
-        # plt.plot(xscaled)
-        # plt.plot(yscaled)
-        # plt.show()
+    def waveform_chunks(self, staged=None):
+        """The frame waveform split into callback chunks, shape (chunks_per_frame, n_ao_channels, samples_per_chunk).
 
-        stacked_wave = np.vstack((xscaled, yscaled))
-        stacked_wave = np.clip(stacked_wave, self.ao_args['min_val'], self.ao_args['max_val'])
-        # print(stacked_wave.shape) # shape should be nchannels, nsamples
-        return stacked_wave
+        Chunk-major, so every chunk is a C-contiguous block that can go straight to the AO writer. Compiled once per
+        parameter set and cached, only in this layout. Don't modify it in place. staged overrides LIVE_PARAMS, to
+        compile the waveform of parameters about to be swapped in.
+        """
+        trajectory = self.trajectory
+        snapshot = scan, limits, key = self._scan_snapshot(staged, trajectory)
+        if trajectory is not None:
+            compiled = self.compiled_scan(snapshot)
+            chunk_lines = self._chunk_lines(compiled.shape[0], compiled.samples_per_row,
+                                            row_periodic=compiled.row_periodic)
+        else:
+            chunk_lines = self._chunk_lines(scan.pixels_y, scan.pixels_x * scan.samples_per_pixel,
+                                            line_pairs=scan.bidirectional)
+
+        def build():
+            # Only the snapshot, the attributes may have changed since
+            if trajectory is not None:
+                frame, rows = compiled.waveform, compiled.shape[0]
+            else:
+                frame, rows = scan.compile(*limits).waveform, scan.pixels_y
+            # A view of the trajectory's own waveform if it's a single chunk
+            return np.ascontiguousarray(frame.reshape(len(frame), rows // chunk_lines, -1).transpose(1, 0, 2))
+
+        return self.waveform_cache.get(key + ('chunks', chunk_lines), build)
+
+    def _write_chunk(self):
+        chunks = self._ao_chunks  # Set by start() and apply_staged_params, no lookup in the callback
+        self.ao_task.write(chunks[self._ao_chunk], timeout=5.0)
+        self._ao_chunk += 1
+        if self._ao_chunk == len(chunks):
+            self._ao_chunk = 0
+            self.ao_counter += 1
+
+    def scale_frame(self, frame):
+        """A (channel, y, x) frame in volts, as float32. Raw frames are scaled here, on demand, so only the frames a
+        consumer actually looks at (e.g. the decimated display copy) pay for the conversion"""
+        if not self.raw:
+            return frame
+        if self.binning == 'count':
+            return frame.astype(np.float32)
+        if self.binning == 'sum':
+            # Sum of the scaled samples, assumes the calibration is close to linear over a pixel
+            n = self.pixel_samples
+            volts = scale_counts(frame / n, self.ai_scaling_coeffs)
+            volts *= n
+            return volts
+        return scale_counts(frame, self.ai_scaling_coeffs)
+
+    def set_line_phase(self, phase):
+        """Set the bidirectional line phase correction, safe to call while scanning"""
+        self.line_phase = phase
+        # Built here and swapped in with one assignment, the callback never sees a half-built corrector
+        if self.bidirectional and self.trajectory is None:
+            self.line_corrector = LineCorrector(self.chunk_lines, self.samples_per_line, phase,
+                                                dtype=np.int16 if self.raw else np.float64)
+        else:
+            self.line_corrector = None
+
+    def auto_line_phase(self):
+        """Estimate the line phase from the last acquired chunk (cross-correlating adjacent lines) and apply it"""
+        assert self.bidirectional, "Line phase only applies to bidirectional scans"
+        # The last chunk was already corrected with the current phase, so the estimate is relative to it
+        residual = estimate_line_phase(self.read_buffer[0], self.chunk_lines, self.samples_per_line, corrected=True)
+        self.set_line_phase(self.line_phase + residual)
+        return self.line_phase
 
     def writing_task_callback(self, task_idx, event_type, num_samples, callback_data):
         """This callback is called every time a defined amount of samples have been transferred from the device output
@@ -197,8 +682,19 @@ class WaveformGen:
             num_samples (int): Number of samples that was writen into the write buffer.
             callback_data (object): User data - I use this arg to pass signal generator object.
         """
-        self.writer.write_many_sample(self.waveform(), timeout=5.0)
-        self.ao_counter += 1
+        start = time.perf_counter()
+        # Headroom is measured before servicing the buffer, i.e. at its lowest point
+        space = self.ao_task.space_avail() if self.metrics_enabled else None
+        if self._staged and self._ao_chunk == 0:  # Only swap parameters in at a frame boundary
+            self.apply_staged_params()
+        try:
+            # The matching slice of the cached frame waveform
+            self._write_chunk()
+        except Exception:
+            self.metrics.underflows += 1
+            raise
+        if self.metrics_enabled:
+            self.metrics.record_ao(start, time.perf_counter() - start, space)
 
         # The callback function must return 0 to prevent raising TypeError exception.
         return 0
@@ -215,37 +711,73 @@ class WaveformGen:
             callback_data (object)[None]: User data can be additionally passed here, if needed.
         """
 
-        self.reader.read_many_sample(self.read_buffer, num_samples, timeout=nidaqmx.constants.WAIT_INFINITELY)
-        newframe = self.read_buffer.copy().astype(np.float32).reshape(self.pixels_y, self.pixels_x).T
-        # TODO assuming one channel
-        if self.reading_image_callback:
-            self.reading_image_callback(newframe)
-        self.frames.append(newframe)
-        self.ai_counter += 1
+        start = time.perf_counter()
+        avail = self.ai_task.avail_samples() if self.metrics_enabled else None
+        try:
+            self.ai_task.read(self.read_buffer, num_samples)
+        except Exception:
+            self.metrics.overruns += 1
+            raise
+        # Demux each channel (a row view of the read buffer) and bin the samples of each pixel straight into the lines of
+        # this chunk in its plane of the current preallocated ring slot, frames are (channel, y, x), no allocation
+        if self._ai_chunk == 0:
+            self._slot = self.ring.acquire()
+        line0 = self._ai_chunk * self._chunk_rows
+        lines = slice(line0, line0 + self._chunk_rows)
+        corrector = self.line_corrector
+        for samples, plane in zip(self.read_buffer, self._slot):
+            if corrector is not None:
+                corrector(samples)
+            self.binner(samples, plane[lines])
+        self._ai_chunk += 1
+
+        if self._ai_chunk < self._n_chunks:
+            if self.reading_lines_callback:
+                self.reading_lines_callback(*self.ring.current(), lines.stop)
+        else:
+            self._ai_chunk = 0
+            seq, newframe = self.ring.publish()
+            if self.reading_lines_callback:
+                self.reading_lines_callback(seq, newframe, lines.stop)
+            if self.reading_image_callback:
+                self.reading_image_callback(seq, newframe)
+            if self.recorder is not None:
+                if self._recorded_changes < len(self.param_changes) and \
+                        self.param_changes[self._recorded_changes][0] <= self.ai_counter:
+                    # First frame scanned with staged parameters, it starts a new series with them
+                    self._recorded_changes = len(self.param_changes)
+                    self.recorder.set_metadata(self.recorder_metadata())
+                self.recorder.push_slot(self.ring, seq)
+            if self.publisher is not None:
+                self.publisher.publish(newframe)
+            if self.pipeline is not None:
+                self.pipeline.submit(self.ring, seq)
+            self.ai_counter += 1
+        if self.metrics_enabled:
+            self.metrics.record_ai(start, time.perf_counter() - start, avail)
 
         # The callback function must return 0 to prevent raising TypeError exception.
         return 0
 
 
 if __name__ == '__main__':
-    import time
+    from matplotlib import pyplot as plt
 
     gen = WaveformGen(devname='Dev1')
     print(f"FPS: {gen.fps}")
+    gen.start_recording('frames.tif')
     gen.start()
     time.sleep(4)
+    gen.stop()
     gen.close()
-    from skimage import io
+    print(gen.stop_recording().stats())
 
     data = gen.read_buffer.copy()
-    io.imsave('x.tiff', np.stack([f[0, ...].reshape((gen.pixels_y, gen.pixels_x)) for f in gen.frames]))
-    io.imsave('y.tiff', np.stack([f[1, ...].reshape((gen.pixels_y, gen.pixels_x)) for f in gen.frames]))
-
     print(data.shape)
 
     plt.figure()
-    plt.plot(data[0, :])
-    plt.plot(data[1, :])
+    for ch in data:
+        plt.plot(ch)
     plt.show()
 
     # gen.start()